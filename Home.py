@@ -3,6 +3,9 @@ import random
 
 import streamlit as st
 
+# starts the ingest worker as the app starts, whichever page is opened first imports the module
+import lib.st.cached
+
 logger = logging.getLogger(__name__)
 
 
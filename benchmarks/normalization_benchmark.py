@@ -0,0 +1,51 @@
+import time
+
+import click
+import numpy as np
+
+from lib.ingest.kembeddings import norm_embed, norm_embed_batch
+from lib.utils.yaml_utils import load_yaml_file
+
+
+def per_vector_path(embs):
+    # NormalizedEmbeddings before batching: one float64 array per vector, converted again by FAISS.
+    return np.array([norm_embed(emb) for emb in embs], dtype=np.float32)
+
+
+def batch_path(embs):
+    return norm_embed_batch(embs)
+
+
+def best_of(fn, embs, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(embs)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+@click.command()
+@click.option("--sizes", default="1000,10000,100000", help="Comma separated vector counts.")
+@click.option("--dims", default=None, type=int, help="Vector dimensions, defaults to embeddings.dimensions.")
+@click.option("--repeat", default=3, help="Runs per measurement, best one is reported.")
+def main(sizes, dims, repeat):
+    if dims is None:
+        dims = load_yaml_file("config/config.yml")['config']['embeddings']['dimensions']
+
+    rng = np.random.default_rng(0)
+
+    print(f"{'vectors':>10} {'per-vector (s)':>15} {'batch (s)':>10} {'speedup':>8}")
+    for size in [int(size) for size in sizes.split(",")]:
+        # Rows arrive one array per text, as returned by the embedding client.
+        embs = list(rng.standard_normal((size, dims)))
+
+        assert np.allclose(per_vector_path(embs[:10]), batch_path(embs[:10]), atol=1e-6)
+
+        per_vector = best_of(per_vector_path, embs, repeat)
+        batch = best_of(batch_path, embs, repeat)
+        print(f"{size:>10} {per_vector:>15.4f} {batch:>10.4f} {per_vector / batch:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+import gc
+import json
+import os
+import platform
+import resource
+import tempfile
+import time
+
+import click
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+
+from lib.ingest import faiss_index
+from lib.ingest.kembeddings import norm_embed_batch
+from lib.ingest.kvectorstore import FaissDocumentsWithScoreRetriever, KFaissVectorStore
+from lib.utils.yaml_utils import load_yaml_file
+
+batch_size = 10000
+
+
+class QueryEmbeddings:
+    # documents are added with add_embedded, queries are named "q<i>" so that retrievers embed them by lookup
+    def __init__(self, dims, queries=None):
+        self.dims = dims
+        self.queries = queries
+
+    def embed_query(self, text):
+        return self.queries[int(text[1:])]
+
+
+def synthetic_corpus(seed, size, dims, topics, spread):
+    """Batches of normalized vectors scattered around `topics` random topic vectors, generated lazily so that a
+    million vectors never sit in memory next to the store."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((topics, dims)).astype(np.float32)
+    for start in range(0, size, batch_size):
+        n = min(batch_size, size - start)
+        yield start, norm_embed_batch(centers[rng.integers(topics, size=n)]
+                                      + spread * rng.standard_normal((n, dims)).astype(np.float32))
+
+
+def synthetic_queries(seed, count, dims, topics, spread):
+    # same topics as the corpus, the corpus generator draws from its own rng
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((topics, dims)).astype(np.float32)
+    rng = np.random.default_rng(seed + 1)
+    return norm_embed_batch(centers[rng.integers(topics, size=count)]
+                            + spread * rng.standard_normal((count, dims)).astype(np.float32))
+
+
+def rss_mb():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def store_config(index_config, mmap):
+    return {'provider': 'faiss', 'mmap': mmap, 'index': index_config, 'result_cache': {'max_entries': 0},
+            'persistence': {'background_compaction': False, 'compact_threshold': 10 ** 9}}
+
+
+def build(name, index_config, mmap, corpus, queries, k):
+    """Adds the corpus to a new store and writes its base index, returns the build seconds and exact top k ids."""
+    store = KFaissVectorStore(QueryEmbeddings(queries.shape[1]), name, store_config(index_config, mmap))
+    exact = faiss.IndexFlatIP(queries.shape[1])
+    truth_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    truth_ids = np.full((len(queries), k), -1, dtype=np.int64)
+
+    seconds = 0.0
+    for start, vectors in corpus:
+        documents = [Document(page_content=str(start + i), metadata={"file_name": "bench"})
+                     for i in range(len(vectors))]
+        begin = time.perf_counter()
+        store.add_embedded(documents, vectors)
+        seconds += time.perf_counter() - begin
+
+        # ground truth merged batch by batch, the same exact inner product search the flat index does
+        exact.reset()
+        exact.add(vectors)
+        scores, ids = exact.search(queries, min(k, len(vectors)))
+        scores = np.hstack([truth_scores, scores])
+        ids = np.hstack([truth_ids, ids + start])
+        best = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+        truth_scores = np.take_along_axis(scores, best, axis=1)
+        truth_ids = np.take_along_axis(ids, best, axis=1)
+
+    begin = time.perf_counter()
+    store.persist()
+    seconds += time.perf_counter() - begin
+    return seconds, [set(row[row >= 0].tolist()) for row in truth_ids]
+
+
+def index_bytes(name):
+    store_path = os.path.join(KFaissVectorStore.store_root, KFaissVectorStore.store_dir.format(name=name))
+    return sum(os.path.getsize(os.path.join(store_path, file)) for file in os.listdir(store_path)
+               if file.endswith(".faiss"))
+
+
+def measure(name, index_config, mmap, queries, truth, k, warmup):
+    """Opens the written store like the app does after a restart and queries it through the retriever."""
+    gc.collect()
+    rss_before = rss_mb()
+
+    begin = time.perf_counter()
+    store = KFaissVectorStore(QueryEmbeddings(queries.shape[1], queries), name, store_config(index_config, mmap))
+    open_seconds = time.perf_counter() - begin
+
+    retriever = FaissDocumentsWithScoreRetriever(vector_store=store, search_kwargs={"k": k, "fetch_k": k * 5})
+    for i in range(min(warmup, len(queries))):
+        retriever.invoke(f"q{i}")
+
+    latencies, recalls = [], []
+    for i, expected in enumerate(truth):
+        begin = time.perf_counter()
+        docs = retriever.invoke(f"q{i}")
+        latencies.append(time.perf_counter() - begin)
+        recalls.append(len({int(doc.page_content) for doc in docs} & expected) / len(expected))
+
+    result = {"index_type": faiss_index.index_type(store.base_index) if store.base_index is not None else None,
+              "open_seconds": round(open_seconds, 4),
+              "rss_mb": round(rss_mb() - rss_before, 1),
+              "p50_ms": round(1000 * float(np.percentile(latencies, 50)), 3),
+              "p95_ms": round(1000 * float(np.percentile(latencies, 95)), 3),
+              f"recall_at_{k}": round(float(np.mean(recalls)), 4)}
+    del retriever, store
+    return result
+
+
+def search_points(kind, index_config, nprobes, ef_searches):
+    """The search knob values to sweep for an index type, the configured one only for flat."""
+    if kind in (faiss_index.IVF_FLAT, faiss_index.IVF_PQ):
+        return [index_config | {'nprobe': nprobe} for nprobe in nprobes]
+    if kind == faiss_index.HNSW:
+        return [index_config | {'ef_search': ef_search} for ef_search in ef_searches]
+    return [index_config]
+
+
+def _ints(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+@click.command()
+@click.option("--sizes", default="10000,100000,1000000", help="Comma separated corpus sizes in vectors.")
+@click.option("--types", "kinds", default="flat,ivf_flat,ivf_pq,hnsw", help="Comma separated index types.")
+@click.option("--queries", default=500)
+@click.option("--k", default=10)
+@click.option("--nprobe", default="4,16,64", help="Comma separated ivf nprobe values to sweep.")
+@click.option("--ef-search", default="16,64,256", help="Comma separated hnsw ef_search values to sweep.")
+@click.option("--topics", default=1000, help="Clusters the synthetic vectors scatter around.")
+@click.option("--spread", default=0.6, help="Vector distance from its topic, higher is harder for ann indexes.")
+@click.option("--warmup", default=20, help="Queries run before timing.")
+@click.option("--dims", default=None, type=int, help="Vector dimensions, defaults to embeddings.dimensions.")
+@click.option("--mmap/--no-mmap", default=None, help="Memory map the base index, defaults to vector_store.mmap.")
+@click.option("--seed", default=0)
+@click.option("--output", default=None, type=click.Path(dir_okay=False), help="JSON file the results are written to.")
+def main(sizes, kinds, queries, k, nprobe, ef_search, topics, spread, warmup, dims, mmap, seed, output):
+    config = load_yaml_file("config/config.yml")['config']
+    dims = dims or config['embeddings']['dimensions']
+    mmap = config['vector_store'].get('mmap', True) if mmap is None else mmap
+    configured_index = config['vector_store'].get('index', {})
+
+    query_vectors = synthetic_queries(seed, queries, dims, topics, spread)
+    results = []
+
+    print(f"{'vectors':>8} {'index':>9} {'knob':>13} {'build (s)':>10} {'open (s)':>9} {'index MB':>9} "
+          f"{'rss MB':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {f'recall@{k}':>10}")
+    for size in _ints(sizes):
+        for kind in kinds.split(","):
+            # promote_at 0 builds the requested type at every size it can be trained at
+            index_config = configured_index | {'type': kind, 'promote_at': 0}
+            name = f"bench_{kind}_{size}"
+
+            with tempfile.TemporaryDirectory() as tmp:
+                cwd = os.getcwd()
+                os.chdir(tmp)
+                try:
+                    build_seconds, truth = build(name, index_config, mmap,
+                                                 synthetic_corpus(seed, size, dims, topics, spread), query_vectors, k)
+                    size_mb = index_bytes(name) / 2 ** 20
+                    for point in search_points(faiss_index.target_type(index_config, size), index_config,
+                                               _ints(nprobe), _ints(ef_search)):
+                        result = {"vectors": size, "dims": dims, "requested_type": kind, "mmap": mmap,
+                                  "nprobe": point.get('nprobe', 16), "ef_search": point.get('ef_search', 64),
+                                  "build_seconds": round(build_seconds, 3), "index_mb": round(size_mb, 1),
+                                  "peak_rss_mb": None}
+                        result |= measure(name, point, mmap, query_vectors, truth, k, warmup)
+                        result["peak_rss_mb"] = round(peak_rss_mb(), 1)
+                        results.append(result)
+
+                        kind_label = result['index_type'] or "flat"
+                        knob = f"nprobe={result['nprobe']}" if kind_label.startswith("ivf") else \
+                            f"ef_search={result['ef_search']}" if kind_label == "hnsw" else "-"
+                        print(f"{size:>8} {kind_label:>9} {knob:>13} {build_seconds:>10.2f} "
+                              f"{result['open_seconds']:>9.3f} {size_mb:>9.1f} {result['rss_mb']:>8.1f} "
+                              f"{result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result[f'recall_at_{k}']:>10.3f}")
+                finally:
+                    os.chdir(cwd)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"machine": {"platform": platform.platform(), "processor": platform.processor(),
+                                   "cpus": os.cpu_count(), "faiss": faiss.__version__},
+                       "parameters": {"queries": queries, "k": k, "topics": topics, "spread": spread,
+                                      "warmup": warmup, "seed": seed, "index": configured_index},
+                       "results": results}, f, indent=2)
+        print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import os
+import tempfile
+import time
+
+import click
+import numpy as np
+from langchain_core.documents import Document
+
+from lib.ingest import faiss_index
+from lib.ingest.file_router import FileRouter
+from lib.ingest.kembeddings import norm_embed_batch
+from lib.ingest.kvectorstore import KVectorStore
+from lib.utils.yaml_utils import load_yaml_file
+
+
+class PrecomputedEmbeddings:
+    # vectors are added with add_embedded and searched by vector, only the dimensions are needed
+    def __init__(self, dims):
+        self.dims = dims
+
+
+def synthetic_library(rng, files, chunks_per_file, dims, spread):
+    # chunks of a file scatter around a topic vector, its summary sits close to the topic
+    topics = rng.standard_normal((files, dims))
+    chunks = norm_embed_batch(np.repeat(topics, chunks_per_file, axis=0)
+                              + spread * rng.standard_normal((files * chunks_per_file, dims)))
+    summaries = norm_embed_batch(topics + 0.5 * spread * rng.standard_normal((files, dims)))
+    return chunks, summaries
+
+
+def build_stores(files, chunks_per_file, chunks, summaries, store_config, top_files):
+    embeddings = PrecomputedEmbeddings(chunks.shape[1])
+    chunk_store = KVectorStore(embeddings, "bench_chunks", store_config)
+    summary_store = KVectorStore(embeddings, "bench_summaries", store_config)
+
+    for f in range(files):
+        rows = slice(f * chunks_per_file, (f + 1) * chunks_per_file)
+        chunk_store.vector_store.add_embedded(
+            [Document(page_content=f"file {f} chunk {i}", metadata={"file_name": f"file-{f}"})
+             for i in range(chunks_per_file)], chunks[rows])
+
+    summary_store.vector_store.add_embedded(
+        [Document(page_content=f"file {f}", metadata={"file_name": f"file-{f}"}) for f in range(files)],
+        summaries, ids=[f"file-{f}" for f in range(files)])
+
+    chunk_store.vector_store.persist()
+    summary_store.vector_store.persist()
+    return chunk_store.vector_store, FileRouter(summary_store, top_files)
+
+
+def recall_at_k(results, truth):
+    return np.mean([len({doc.page_content for doc, _ in docs} & expected) / len(expected)
+                    for docs, expected in zip(results, truth)])
+
+
+def run(store, router, chunks, chunks_per_file, queries, k):
+    # exact top k, the full search is approximate too once the store is promoted to an ann index
+    top = np.argsort(-(queries @ chunks.T), axis=1)[:, :k]
+    truth = [{f"file {i // chunks_per_file} chunk {i % chunks_per_file}" for i in row} for row in top]
+
+    full, routed, full_seconds, routed_seconds = [], [], 0.0, 0.0
+    for query in queries:
+        start = time.perf_counter()
+        full.append(store.similarity_search_with_score_by_vector(query, k=k))
+        full_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        file_names = router.route_by_vector(query)
+        search_filter = None if file_names is None else {"file_name": file_names}
+        routed.append(store.similarity_search_with_score_by_vector(query, k=k, filter=search_filter))
+        routed_seconds += time.perf_counter() - start
+
+    return (recall_at_k(full, truth), recall_at_k(routed, truth),
+            1000 * full_seconds / len(queries), 1000 * routed_seconds / len(queries))
+
+
+@click.command()
+@click.option("--files", default="100,1000,4000", help="Comma separated library sizes in files.")
+@click.option("--chunks-per-file", default=40)
+@click.option("--top-files", default=20, help="Files routed to per query.")
+@click.option("--queries", default=200)
+@click.option("--k", default=10)
+@click.option("--spread", default=0.6, help="Chunk distance from the file topic, higher is harder to route.")
+@click.option("--dims", default=None, type=int, help="Vector dimensions, defaults to embeddings.dimensions.")
+def main(files, chunks_per_file, top_files, queries, k, spread, dims):
+    config = load_yaml_file("config/config.yml")['config']
+    dims = dims or config['embeddings']['dimensions']
+    store_config = {'provider': 'faiss', 'index': config['vector_store'].get('index', {}),
+                    'persistence': {'background_compaction': False, 'compact_threshold': 10 ** 9}}
+
+    rng = np.random.default_rng(0)
+
+    print(f"{'files':>7} {'chunks':>8} {'index':>9} {'full recall':>12} {'routed recall':>14} {'full (ms)':>10} "
+          f"{'routed (ms)':>12}")
+    for file_count in [int(size) for size in files.split(",")]:
+        chunks, summaries = synthetic_library(rng, file_count, chunks_per_file, dims, spread)
+        picked = rng.choice(len(chunks), queries)
+        query_vectors = norm_embed_batch(chunks[picked] + 0.3 * spread * rng.standard_normal((queries, dims)))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                store, router = build_stores(file_count, chunks_per_file, chunks, summaries, store_config, top_files)
+                full_recall, routed_recall, full_ms, routed_ms = run(store, router, chunks, chunks_per_file,
+                                                                     query_vectors, k)
+            finally:
+                os.chdir(cwd)
+
+        index = faiss_index.target_type(store_config['index'], len(chunks))
+        print(f"{file_count:>7} {len(chunks):>8} {index:>9} {full_recall:>12.3f} {routed_recall:>14.3f} "
+              f"{full_ms:>10.2f} {routed_ms:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+import zlib
+
+import click
+from sqlalchemy import Column, Integer, MetaData, Table, Text, create_engine, insert, select
+
+from lib.db.db_manager import DatabaseManager
+from lib.db.model import FileChunk, UserFile, Utterance
+from lib.db.types import Compressed, CompressedText
+from lib.utils.yaml_utils import load_yaml_file
+
+compressed_columns = [(column.table.name, column.name) for column in
+                      (UserFile.__table__.c.content, FileChunk.__table__.c.content, Utterance.__table__.c.debug)]
+
+
+def column_bytes(path):
+    """Stored bytes of the compressed columns and the database file size."""
+    conn = sqlite3.connect(path)
+    try:
+        sizes = {f"{table}.{column}": conn.execute(f"SELECT COALESCE(SUM(LENGTH(CAST({column} AS BLOB))), 0) "
+                                                   f"FROM {table}").fetchone()[0]
+                 for table, column in compressed_columns}
+    finally:
+        conn.close()
+    sizes["file"] = os.path.getsize(path)
+    return sizes
+
+
+def vacuum(path):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def database_report(database, level):
+    """Sizes of a copy of `database` before and after the migration compresses it."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "copy.db")
+        shutil.copyfile(database, path)
+        vacuum(path)
+        before = column_bytes(path)
+
+        begin = time.perf_counter()
+        DatabaseManager(f"sqlite:///{path}", compression_level=level).engine.dispose()
+        seconds = time.perf_counter() - begin
+
+        vacuum(path)
+        after = column_bytes(path)
+    return before, after, seconds
+
+
+def sample_texts(database, count, seed):
+    """Chunk texts of `database`, or synthetic ones when it has none, repeated up to `count`."""
+    texts = []
+    if database and os.path.exists(database):
+        conn = sqlite3.connect(database)
+        try:
+            rows = conn.execute("SELECT content FROM file_chunks WHERE content IS NOT NULL LIMIT ?", (count,))
+            texts = [content if isinstance(content, str) else zlib.decompress(content).decode("utf-8")
+                     for content, in rows]
+        finally:
+            conn.close()
+
+    if not texts:
+        rng = random.Random(seed)
+        # a zipf like vocabulary, prose repeats its common words
+        words = [f"word{i}" for i in range(5000)]
+        weights = [1 / (i + 1) for i in range(len(words))]
+        texts = [" ".join(rng.choices(words, weights, k=rng.randint(40, 70))) for _ in range(min(count, 5000))]
+    return [texts[i % len(texts)] for i in range(count)]
+
+
+def throughput(texts, level):
+    """Write and read MB/s of `texts` through a text column, compressed at `level` or plain when None."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        engine = create_engine(f"sqlite:///{path}")
+        if level is not None:
+            Compressed.level = level
+        table = Table("chunks", MetaData(), Column("id", Integer, primary_key=True),
+                      Column("content", Text if level is None else CompressedText))
+        table.create(engine)
+
+        megabytes = sum(len(text.encode("utf-8")) for text in texts) / 2 ** 20
+        begin = time.perf_counter()
+        with engine.begin() as conn:
+            conn.execute(insert(table), [{"id": i, "content": text} for i, text in enumerate(texts)])
+        write_seconds = time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        with engine.connect() as conn:
+            read = conn.execute(select(table.c.content)).scalars().all()
+        read_seconds = time.perf_counter() - begin
+        assert len(read) == len(texts)
+
+        engine.dispose()
+        vacuum(path)
+        return {"level": level, "file_mb": round(os.path.getsize(path) / 2 ** 20, 2),
+                "write_mb_s": round(megabytes / write_seconds, 1), "read_mb_s": round(megabytes / read_seconds, 1),
+                "write_rows_s": round(len(texts) / write_seconds), "read_rows_s": round(len(texts) / read_seconds)}
+
+
+def _ints(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+@click.command()
+@click.option("--database", default=None, type=click.Path(dir_okay=False),
+              help="SQLite database to report on, defaults to db.connection_string. A copy is compressed.")
+@click.option("--chunks", default=20000, help="Chunk texts written and read per compression level.")
+@click.option("--levels", default="1,6,9", help="Comma separated zlib levels to measure.")
+@click.option("--seed", default=0)
+@click.option("--output", default=None, type=click.Path(dir_okay=False), help="JSON file the results are written to.")
+def main(database, chunks, levels, seed, output):
+    config = load_yaml_file("config/config.yml")['config']
+    level = config['db'].get('compression_level', 6)
+    if database is None:
+        connection_string = config['db']['connection_string']
+        database = connection_string[len("sqlite:///"):] if connection_string.startswith("sqlite:///") else None
+
+    report = {}
+    if database and os.path.exists(database):
+        before, after, seconds = database_report(database, level)
+        report["database"] = {"path": database, "level": level, "migration_seconds": round(seconds, 2),
+                              "before": before, "after": after}
+
+        print(f"{database} at level {level}, migrated in {seconds:.1f}s")
+        print(f"{'':>22} {'before MB':>10} {'after MB':>10} {'ratio':>7}")
+        for key in before:
+            ratio = before[key] / after[key] if after[key] else 0
+            print(f"{key:>22} {before[key] / 2 ** 20:>10.2f} {after[key] / 2 ** 20:>10.2f} {ratio:>7.2f}")
+    else:
+        print("No database to report on, measuring throughput only")
+
+    texts = sample_texts(database, chunks, seed)
+    default_level = Compressed.level
+    try:
+        results = [throughput(texts, point) for point in [None] + _ints(levels)]
+    finally:
+        Compressed.level = default_level
+    report["throughput"] = results
+
+    print(f"\n{len(texts)} chunks, {sum(len(text) for text in texts) / 2 ** 20:.1f} MB of text")
+    print(f"{'level':>6} {'file MB':>8} {'write MB/s':>11} {'read MB/s':>10} {'write rows/s':>13} {'read rows/s':>12}")
+    for result in results:
+        label = "plain" if result['level'] is None else str(result['level'])
+        print(f"{label:>6} {result['file_mb']:>8.2f} {result['write_mb_s']:>11.1f} {result['read_mb_s']:>10.1f} "
+              f"{result['write_rows_s']:>13} {result['read_rows_s']:>12}")
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"machine": {"platform": platform.platform(), "cpus": os.cpu_count(),
+                                   "zlib": zlib.ZLIB_RUNTIME_VERSION},
+                       "parameters": {"chunks": chunks, "levels": levels, "seed": seed}, **report}, f, indent=2)
+        print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
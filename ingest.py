@@ -0,0 +1,166 @@
+import hashlib
+import os
+import time
+
+import click
+
+from lib.chain.prompt_registry import PromptRegistry
+from lib.chain.summary_chain import file_summarizer
+from lib.db.db_manager import DatabaseManager
+from lib.ingest.docstores import FileChunkDocstore
+from lib.ingest.file_router import FileRouter
+from lib.ingest.ingest_worker import IngestWorker
+from lib.ingest.ingestion_pipeline import IngestionPipeline
+from lib.ingest.kembeddings import KEmbeddings
+from lib.ingest.kvectorstore import KVectorStore
+from lib.llm.kllm import Kllm
+from lib.service.file_chunk_service import FileChunkService
+from lib.ingest.store_lock import StoreLockedError
+from lib.ingest.user_file_index_builders import is_streamable
+from lib.service.ingest_job_service import IngestJobService, file_hash
+from lib.service.user_file_service import UserFileService
+from lib.utils.yaml_utils import load_yaml_file
+
+extensions = ("md", "txt", "pdf", "html", "htm")
+
+
+def find_files(directory):
+    """Relative paths of the supported files under `directory`, the path is the name a file is stored under."""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            if file.lower().rsplit(".", 1)[-1] in extensions:
+                path = os.path.join(root, file)
+                yield os.path.relpath(path, directory), path
+
+
+def build_pipeline(config, db_manager, summarize) -> IngestionPipeline:
+    """The pipeline of the app's ingest worker, built without streamlit whose resource cache needs a running app."""
+    vector_store_config = config['vector_store']
+    embeddings = KEmbeddings(config['embeddings'])
+    chunk_service = FileChunkService(db_manager)
+    chunk_service.backfill_content_hashes()
+    docstore = FileChunkDocstore(chunk_service, vector_store_config.get('hot_documents', 1024))
+    vector_store = KVectorStore(embeddings, "user_files", vector_store_config, docstore)
+
+    router = None
+    routing = vector_store_config.get('routing', {})
+    if routing.get('enabled'):
+        summary_store = KVectorStore(embeddings, "user_file_summaries",
+                                     vector_store_config | {'hybrid': {}, 'sharding': {}})
+        router = FileRouter(summary_store, routing.get('top_files', 20))
+
+    ingestion = config.get('ingestion', {})
+    return IngestionPipeline(vector_store, UserFileService(db_manager), summarize, router,
+                             parse_workers=ingestion.get('parse_workers', 0),
+                             embed_workers=ingestion.get('embed_workers', 2),
+                             summary_workers=ingestion.get('summary_workers', 2),
+                             pdf_min_pages_per_task=ingestion.get('pdf_min_pages_per_task', 8),
+                             chunk_service=chunk_service,
+                             stream_min_bytes=ingestion.get('stream_min_bytes', 32 * 2 ** 20),
+                             stream_block_bytes=ingestion.get('stream_block_bytes', 2 ** 20),
+                             stream_batch_size=ingestion.get('stream_batch_size', 256))
+
+
+class Throughput:
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.start = time.perf_counter()
+        self.embedded_at_start = pipeline.embedded_texts
+        self.files = 0
+        self.chunks = 0
+        self.failed = 0
+
+    def record(self, files, failed):
+        saved = [file for file in files if file not in failed]
+        self.files += len(saved)
+        # streamed files are indexed without holding their chunks, their embeddings are counted
+        self.chunks += sum(len(file.chunks) for file in saved if file.chunks is not None)
+        self.failed += len(failed)
+
+    def __str__(self):
+        seconds = max(time.perf_counter() - self.start, 1e-9)
+        embedded = self.pipeline.embedded_texts - self.embedded_at_start
+        summary = (f"{self.files} files, {self.chunks} chunks, {embedded} embeddings, {self.failed} failed in "
+                   f"{seconds:.1f}s: {self.files / seconds:.2f} files/s, {self.chunks / seconds:.1f} chunks/s, "
+                   f"{embedded / seconds:.1f} embeddings/s")
+        cache = self.pipeline.vector_store.embeddings.cache_stats()
+        if cache is not None:
+            summary += f", embedding cache hit rate {cache['hit_rate']:.0%}"
+        return summary
+
+
+@click.command()
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option("--batch-size", default=None, type=int, help="Files ingested together, defaults to ingestion.batch_size.")
+@click.option("--summarize/--no-summarize", default=True, help="Generate file summaries with the llm.")
+@click.option("--resume/--no-resume", default=True,
+              help="Queue again the jobs left running by a stopped run.")
+def main(directory, batch_size, summarize, resume):
+    """Ingests the md, txt, pdf and html files under DIRECTORY.
+
+    Every file goes through the ingest job queue the Upload page uses, so a stopped run picks up where it was and
+    files already ingested, or queued by the app, are skipped by their content hash. A changed file is stored again
+    under its path, only its changed chunks are embedded. The app must be stopped, both would write the vector store.
+    """
+    config = load_yaml_file("config/config.yml")['config']
+    batch_size = batch_size or config.get('ingestion', {}).get('batch_size', 8)
+
+    db_manager = DatabaseManager(database_url=config['db']['connection_string'],
+                                 compression_level=config['db'].get('compression_level', 6))
+    job_service = IngestJobService(db_manager)
+    summarize_file = file_summarizer(config, Kllm(config['llms']).get_deterministic_llm(), PromptRegistry()).summarize \
+        if summarize else lambda content, chunks: ""
+    try:
+        pipeline = build_pipeline(config, db_manager, summarize_file)
+    except StoreLockedError as e:
+        raise click.ClickException(f"{e}, stop the app first or upload the files there")
+
+    worker = IngestWorker(job_service, pipeline)
+    if resume:
+        requeued = job_service.requeue_running()
+        if requeued:
+            print(f"Resuming {requeued} interrupted ingest jobs")
+
+    known = UserFileService(db_manager).find_content_hashes()
+    known.update(job.content_hash for job in job_service.find_unfinished())
+
+    throughput = Throughput(pipeline)
+    skipped = 0
+    paths = find_files(directory)
+    while True:
+        # files are queued a batch at a time, the queue holds their content until they are ingested
+        queued = 0
+        for name, path in paths:
+            # large text files are queued by path and streamed from there
+            data = None
+            if is_streamable(name) and os.path.getsize(path) >= pipeline.stream_min_bytes:
+                content_hash = file_hash(path)
+            else:
+                with open(path, "rb") as f:
+                    data = f.read()
+                content_hash = hashlib.sha256(data).hexdigest()
+
+            if content_hash in known:
+                skipped += 1
+                continue
+
+            known.add(content_hash)
+            job_service.enqueue(name, data, None if data is not None else os.path.abspath(path))
+            queued += 1
+            if queued == batch_size:
+                break
+
+        jobs = job_service.claim(batch_size)
+        if not jobs:
+            break
+
+        throughput.record(*worker.run_jobs(jobs))
+        print(f"{throughput}, {skipped} already ingested")
+
+    pipeline.close()
+    print(f"Done: {throughput}, {skipped} already ingested")
+
+
+if __name__ == '__main__':
+    main()
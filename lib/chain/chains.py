@@ -16,6 +16,7 @@ from lib.chain.next_action_chain import get_next_action_chain
 from lib.chain.prompt_registry import PromptRegistry
 from lib.chain.utils import format_chat_history
 from lib.db.model import UserFile
+from lib.ingest.file_router import FileRouter
 from lib.ingest.kvectorstore import KVectorStore
 from lib.llm.kllm import Kllm
 from lib.utils.chain_output_sink import ChainOutputSink
@@ -53,8 +54,10 @@ def build_main_chain(kllm: Kllm, user_file_retriever: BaseRetriever, registry: P
 
 
 def get_main_chain_stream(config, registry: PromptRegistry, session_files: List[UserFile], user_file_vector_store: KVectorStore,
-                          chain_sink: ChainOutputSink) -> Callable:
+                          chain_sink: ChainOutputSink, file_router: FileRouter = None) -> Callable:
     user_file_retriever = user_file_vector_store.get_user_file_retriever()
+    if file_router is not None:
+        user_file_retriever = file_router.retriever(user_file_retriever)
 
     kllm = Kllm(config['llms'])
 
@@ -70,4 +73,9 @@ def get_main_chain_stream(config, registry: PromptRegistry, session_files: List[
             yield chunk
             chat_history.extend([HumanMessage(content=question), AIMessage(content=answer)])
 
+        chain_sink.add_debug(name="retrieval_cache", content=user_file_vector_store.result_cache_stats())
+        embedding_cache = user_file_vector_store.embeddings.cache_stats()
+        if embedding_cache is not None:
+            chain_sink.add_debug(name="embedding_cache", content=embedding_cache)
+
     return add_message
@@ -1,18 +1,21 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from langchain_core.documents import Document
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 
 from lib.chain.prompt_registry import PromptRegistry
-from lib.llm.kllm import Kllm
-from lib.st.cached import config, prompts_registry
-
+from lib.ingest.user_file_index_builders import split_text
+from lib.utils.sqlite_cache import SqliteLruCache
 
-def get_summary_chain(kllm: Kllm, registry: PromptRegistry):
-    generate_file_summary = registry.prompts['generate_file_summary']
 
+def get_summary_chain(llm, registry: PromptRegistry, task: str = 'generate_file_summary'):
     summary_chain = (
         (
-                ChatPromptTemplate.from_template(generate_file_summary)
-                | kllm.get_deterministic_llm()
+                ChatPromptTemplate.from_template(registry.prompts[task])
+                | llm
                 | StrOutputParser()
         )
         .with_config(run_name="SummarizeUploadedFile")
@@ -21,14 +24,85 @@ def get_summary_chain(kllm: Kllm, registry: PromptRegistry):
     return summary_chain
 
 
-def summarize(content: str, max_words=400):
-    words = content.split()
-    truncated_content = ' '.join(words[:max_words])
+class FileSummarizer:
+    """Summarizes a file from its chunks, map-reduce style: groups of chunks are summarized concurrently and their
+    summaries reduced into one, so that the summary covers the whole file instead of its first words.
+
+    Group and file summaries are cached by the hash of their text and prompt, a file uploaded again or retried after
+    a failure is not summarized again.
+    """
+    tasks = {"file": 'generate_file_summary', "part": 'summarize_file_part', "reduce": 'reduce_file_summaries'}
+
+    def __init__(self, llm, registry: PromptRegistry, cache: SqliteLruCache = None, namespace: str = "",
+                 group_chars: int = 6000, max_groups: int = 16, max_workers: int = 4):
+        self.chains = {kind: get_summary_chain(llm, registry, task) for kind, task in self.tasks.items()}
+        self.prompts = {kind: registry.prompts[task] for kind, task in self.tasks.items()}
+        self.cache = cache
+        # the llm summaries are made with, a changed model does not reuse them
+        self.namespace = namespace
+        self.group_chars = group_chars
+        self.max_groups = max_groups
+        self.max_workers = max_workers
+
+    def summarize(self, content: str, chunks: Optional[List[Document]] = None) -> str:
+        texts = [doc.page_content for doc in chunks] if chunks is not None else \
+            [doc.page_content for doc in split_text(content, "")]
+        groups = self._groups(texts)
+        if not groups:
+            return ""
+
+        if len(groups) == 1:
+            return self._summarize("file", {"uploaded_file_content": groups[0]})
+
+        with ThreadPoolExecutor(min(self.max_workers, len(groups)), thread_name_prefix="summary-map") as pool:
+            parts = list(pool.map(lambda group: self._summarize("part", {"uploaded_file_content": group}), groups))
+
+        return self._summarize("reduce", {"part_summaries": "\n".join(f"- {part.strip()}" for part in parts)})
+
+    def _groups(self, texts: List[str]) -> List[str]:
+        # chunks longer than a group, like markdown sections, are cut
+        texts = [text[i:i + self.group_chars] for text in texts for i in range(0, len(text), self.group_chars)]
+
+        groups, group, size = [], [], 0
+        for text in texts:
+            if group and size + len(text) > self.group_chars:
+                groups.append("\n".join(group))
+                group, size = [], 0
+            group.append(text)
+            size += len(text)
+        if group:
+            groups.append("\n".join(group))
+
+        # a large file is summarized from groups spread evenly over it
+        if len(groups) > self.max_groups:
+            groups = [groups[i * len(groups) // self.max_groups] for i in range(self.max_groups)]
+        return groups
+
+    def _summarize(self, kind: str, inputs: dict) -> str:
+        if self.cache is None:
+            return self.chains[kind].invoke(inputs)
+
+        (text,) = inputs.values()
+        key = hashlib.sha256(f"{self.namespace}\n{self.prompts[kind]}\n{text}".encode("utf-8")).hexdigest()
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached.decode("utf-8")
+
+        summary = self.chains[kind].invoke(inputs)
+        self.cache.put(key, summary.encode("utf-8"))
+        return summary
 
-    kllm = Kllm(config()['llms'])
-    prompt_registry = prompts_registry()
 
-    chain = get_summary_chain(kllm, prompt_registry)
-    summary = chain.invoke({"uploaded_file_content": truncated_content})
+def file_summarizer(config, llm, registry: PromptRegistry) -> FileSummarizer:
+    """The summarizer configured by `ingestion.summary`, `config` is the app config."""
+    summary_config = config.get('ingestion', {}).get('summary', {})
+    cache = None
+    if summary_config.get('cache'):
+        cache = SqliteLruCache.shared(summary_config['cache']['path'], summary_config['cache']['max_entries'],
+                                      table="summaries")
 
-    return summary
+    model = config['llms']['deterministic']
+    return FileSummarizer(llm, registry, cache, namespace=f"{model['provider']}/{model['model']}",
+                          group_chars=summary_config.get('group_chars', 6000),
+                          max_groups=summary_config.get('max_groups', 16),
+                          max_workers=summary_config.get('max_workers', 4))
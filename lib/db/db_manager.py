@@ -4,14 +4,18 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 from .base import Base
+from .migrations import migrate
+from .types import Compressed
 
 
 class DatabaseManager:
-    def __init__(self, database_url):
+    def __init__(self, database_url, compression_level: int = 6):
+        Compressed.level = compression_level
         self.engine = create_engine(database_url, pool_size=1, max_overflow=0, pool_recycle=-1)
         self.session_factory = sessionmaker(bind=self.engine)
 
         Base.metadata.create_all(self.engine)
+        migrate(self.engine)
 
     @contextmanager
     def session_scope(self):
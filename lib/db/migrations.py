@@ -0,0 +1,80 @@
+from sqlalchemy import LargeBinary, inspect, text
+
+from .base import Base
+from .types import Compressed
+
+_batch_size = 1000
+
+
+def migrate(engine):
+    """Adds the columns and indexes models gained since their tables were created, `create_all` only creates missing
+    tables. New columns must be nullable, rows already in the table get NULL.
+
+    Data migrations are recorded in the `schema_migrations` table once done and skipped afterwards, they scan whole
+    tables."""
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE IF NOT EXISTS schema_migrations (name VARCHAR PRIMARY KEY)"))
+        done = {name for name, in conn.execute(text("SELECT name FROM schema_migrations"))}
+
+        # inspected on the same connection, the pool of DatabaseManager has a single one
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            added = [column for column in table.columns if column.name not in existing]
+            for column in added:
+                if not column.nullable:
+                    raise Exception("Can not add non nullable column:" + str(column))
+
+                print(f"Adding column {table.name}.{column.name}")
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                                  f"{column.type.compile(engine.dialect)}"))
+
+            for index in table.indexes:
+                if any(column in added for column in index.columns):
+                    index.create(conn, checkfirst=True)
+
+            for column in table.columns:
+                name = f"compress {table.name}.{column.name}"
+                if isinstance(column.type, Compressed) and column.name in existing and name not in done:
+                    compress_column(conn, inspector, table, column)
+                    conn.execute(text("INSERT INTO schema_migrations (name) VALUES (:name)"), {"name": name})
+
+
+def compress_column(conn, inspector, table, column):
+    """Compresses the values a column held as text before it was compressed."""
+    pk = table.primary_key.columns.values()[0].name
+    if conn.dialect.name == "sqlite":
+        # sqlite keeps the declared text type, stored values are either text or compressed blobs
+        where = f"typeof({column.name}) = 'text'"
+    elif conn.dialect.name == "postgresql":
+        types = {c['name']: c['type'] for c in inspector.get_columns(table.name)}
+        if isinstance(types[column.name], LargeBinary):
+            return
+        conn.execute(text(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE "
+                          f"{LargeBinary().compile(conn.dialect)} USING convert_to({column.name}::text, 'UTF8')"))
+        where = "TRUE"
+    else:
+        raise Exception("Unknown dialect:" + str(conn.dialect.name))
+
+    compressed = 0
+    last = None
+    while True:
+        # keyset paged, rows are compressed a batch at a time
+        rows = conn.execute(text(f"SELECT {pk}, {column.name} FROM {table.name} WHERE {where}"
+                                 + (f" AND {pk} > :last" if last is not None else "")
+                                 + f" ORDER BY {pk} LIMIT {_batch_size}"), {"last": last}).fetchall()
+        if not rows:
+            break
+
+        conn.execute(text(f"UPDATE {table.name} SET {column.name} = :value WHERE {pk} = :id"),
+                     [{"id": id_, "value": column.type.compress(value if isinstance(value, str)
+                                                                else bytes(value).decode("utf-8"))}
+                      for id_, value in rows])
+        compressed += len(rows)
+        last = rows[-1][0]
+
+    if compressed:
+        print(f"Compressed {compressed} values of {table.name}.{column.name}")
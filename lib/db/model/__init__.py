@@ -1,4 +1,5 @@
 from .chat_session import ChatSession
 from .file_chunk import FileChunk
+from .ingest_job import IngestJob
 from .user_files import UserFile
 from .utterance import Utterance
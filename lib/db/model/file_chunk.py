@@ -1,9 +1,10 @@
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, String, Text, UniqueConstraint, UUID, Integer
+from sqlalchemy import Column, DateTime, String, UniqueConstraint, UUID, Integer
 from sqlalchemy.orm import deferred
 
 from lib.db.base import Base
+from lib.db.types import CompressedText
 
 
 class FileChunk(Base):
@@ -12,7 +13,8 @@ class FileChunk(Base):
     name = Column(String, nullable=False)
     idx = Column(Integer, nullable=False)
     chunk_id = Column(String, nullable=False)
-    content = deferred(Column(Text, nullable=True))
+    content = deferred(Column(CompressedText, nullable=True))
+    content_hash = Column(String, nullable=True, index=True)
     created = Column(DateTime, nullable=False, default=datetime.utcnow)
     UniqueConstraint('name', 'idx', name='file_name_idx__file_chunks__uq_ind')
 
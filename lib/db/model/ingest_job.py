@@ -0,0 +1,42 @@
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, JSON, LargeBinary, String, Text, UUID
+from sqlalchemy.orm import deferred
+
+from lib.db.base import Base
+
+
+class IngestJob(Base):
+    """An uploaded file waiting for or going through ingestion, with the results of the stages done so far."""
+    __tablename__ = 'ingest_jobs'
+    id = Column(UUID(as_uuid=True), primary_key=True)
+    name = Column(String, nullable=False)
+    status = Column(String, nullable=False, index=True)
+    stage = Column(String, nullable=True)
+    error = Column(String, nullable=True)
+    content_hash = Column(String, nullable=True, index=True)
+    data = deferred(Column(LargeBinary, nullable=True))
+    # a large file is queued by its path, it is read from there instead of data
+    path = Column(String, nullable=True)
+    content = deferred(Column(Text, nullable=True))
+    chunks = deferred(Column(JSON(none_as_null=True), nullable=True))
+    vectors = deferred(Column(LargeBinary, nullable=True))
+    summary = deferred(Column(Text, nullable=True))
+    created = Column(DateTime, nullable=False, default=datetime.utcnow)
+    updated = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __repr__(self):
+        return f"<IngestJob(name={self.name}, id={self.id}, status={self.status}, stage={self.stage})>"
+
+    def __eq__(self, other):
+        if isinstance(other, IngestJob):
+            return self.id == other.id
+        return False
+
+    def __hash__(self):
+        return hash(self.id)
@@ -1,17 +1,19 @@
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, String, Text, UUID, UniqueConstraint
+from sqlalchemy import Column, DateTime, String, UUID, UniqueConstraint
 from sqlalchemy.orm import deferred
 
 from lib.db.base import Base
+from lib.db.types import CompressedText
 
 
 class UserFile(Base):
     __tablename__ = 'user_files'
     id = Column(UUID(as_uuid=True), primary_key=True)
     name = Column(String, nullable=False)
-    content = deferred(Column(Text, nullable=False))
+    content = deferred(Column(CompressedText, nullable=False))
     summary = Column(String, nullable=True)
+    content_hash = Column(String, nullable=True, index=True)
     created = Column(DateTime, nullable=False, default=datetime.utcnow)
     UniqueConstraint('name', name='file_name__user_files__uq_ind')
 
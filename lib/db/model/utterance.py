@@ -3,6 +3,7 @@ from datetime import datetime
 from sqlalchemy import Column, DateTime, String, UUID, JSON
 
 from lib.db.base import Base
+from lib.db.types import CompressedJSON
 
 
 class Utterance(Base):
@@ -12,7 +13,7 @@ class Utterance(Base):
     type = Column(String, nullable=False)
     message = Column(String, nullable=False)
     files = Column(JSON, nullable=True)
-    debug = Column(JSON, nullable=True)
+    debug = Column(CompressedJSON, nullable=True)
     alternatives = Column(JSON, nullable=True)
     created = Column(DateTime, nullable=False, default=datetime.now)
 
@@ -0,0 +1,51 @@
+import json
+import zlib
+
+from sqlalchemy import LargeBinary
+from sqlalchemy.types import TypeDecorator
+
+
+class Compressed(TypeDecorator):
+    """A value stored zlib compressed in a binary column.
+
+    Rows written before their column was compressed are compressed by the migrations DatabaseManager runs on start.
+    `level` is set from `db.compression_level` by DatabaseManager.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    level = 6
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return self.compress(self.serialize(value))
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return self.deserialize(zlib.decompress(value).decode("utf-8"))
+
+    @classmethod
+    def compress(cls, text: str) -> bytes:
+        return zlib.compress(text.encode("utf-8"), cls.level)
+
+    def serialize(self, value) -> str:
+        return value
+
+    def deserialize(self, text: str):
+        return text
+
+
+class CompressedText(Compressed):
+    cache_ok = True
+
+
+class CompressedJSON(Compressed):
+    cache_ok = True
+
+    def serialize(self, value) -> str:
+        return json.dumps(value)
+
+    def deserialize(self, text: str):
+        return json.loads(text)
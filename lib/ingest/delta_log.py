@@ -0,0 +1,107 @@
+import os
+import pickle
+import struct
+import threading
+from typing import Iterator
+
+
+class DeltaLog:
+    """Append-only log of the changes made to a vector store since its base index was last written.
+
+    Every record gets a sequence number so that records already contained in a base index can be skipped on replay.
+    A torn record at the end of the file, left by a crash during append, is dropped on replay.
+    """
+
+    _header = struct.Struct("<I")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.last_seq = 0
+        self.pending = 0
+
+        self._lock = threading.Lock()
+        self._file = None
+
+    def append(self, record: dict) -> int:
+        with self._lock:
+            self.last_seq += 1
+            payload = pickle.dumps(record | {"seq": self.last_seq}, protocol=pickle.HIGHEST_PROTOCOL)
+
+            if self._file is None:
+                self._file = open(self.path, "ab")
+
+            self._file.write(self._header.pack(len(payload)) + payload)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+            self.pending += len(record.get("ids", ()))
+            return self.last_seq
+
+    def replay(self, after_seq: int = 0) -> Iterator[dict]:
+        self.last_seq = max(self.last_seq, after_seq)
+        self.pending = 0
+
+        if not os.path.exists(self.path):
+            return
+
+        valid_size = 0
+        with open(self.path, "rb") as f:
+            for record, end in self._read(f):
+                valid_size = end
+                self.last_seq = max(self.last_seq, record["seq"])
+                if record["seq"] > after_seq:
+                    self.pending += len(record.get("ids", ()))
+                    yield record
+
+        if valid_size < os.path.getsize(self.path):
+            print(f"Dropping torn record at the end of {self.path}")
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_size)
+
+    def truncate(self, up_to_seq: int):
+        """Drops the records with sequence numbers up to `up_to_seq`, they are part of the base index now."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+            if not os.path.exists(self.path):
+                return
+
+            tmp_path = self.path + ".tmp"
+            pending = 0
+            with open(self.path, "rb") as src, open(tmp_path, "wb") as dst:
+                for record, _ in self._read(src):
+                    if record["seq"] > up_to_seq:
+                        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+                        dst.write(self._header.pack(len(payload)) + payload)
+                        pending += len(record.get("ids", ()))
+                dst.flush()
+                os.fsync(dst.fileno())
+
+            os.replace(tmp_path, self.path)
+            self.pending = pending
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _read(self, f):
+        while True:
+            header = f.read(self._header.size)
+            if len(header) < self._header.size:
+                return
+
+            (length,) = self._header.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+
+            try:
+                record = pickle.loads(payload)
+            except Exception:
+                return
+
+            yield record, f.tell()
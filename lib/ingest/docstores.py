@@ -0,0 +1,223 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Iterable, Union
+
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+
+from lib.db.model.file_chunk import FileChunk
+from lib.service.file_chunk_service import FileChunkService
+
+
+def connect(path: str) -> sqlite3.Connection:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SqliteDocstore(Docstore, AddableMixin):
+    """Documents kept in a SQLite file and read only when a search hits them."""
+
+    _batch_size = 500
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS documents "
+                           "(id TEXT PRIMARY KEY, content TEXT NOT NULL, metadata TEXT NOT NULL)")
+        self._conn.commit()
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO documents (id, content, metadata) VALUES (?, ?, ?)",
+                [(id_, doc.page_content, json.dumps(doc.metadata, default=str)) for id_, doc in texts.items()]
+            )
+            self._conn.commit()
+
+    def delete(self, ids: List) -> None:
+        with self._lock:
+            self._conn.executemany("DELETE FROM documents WHERE id = ?", [(id_,) for id_ in ids])
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def search(self, search: str) -> Union[str, Document]:
+        return self.mget([search]).get(search, f"ID {search} not found.")
+
+    def mget(self, ids: Iterable[str]) -> Dict[str, Document]:
+        ids = list(ids)
+        found = {}
+        with self._lock:
+            for i in range(0, len(ids), self._batch_size):
+                batch = ids[i:i + self._batch_size]
+                rows = self._conn.execute(
+                    f"SELECT id, content, metadata FROM documents WHERE id IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update({id_: Document(page_content=content, metadata=json.loads(metadata))
+                              for id_, content, metadata in rows})
+        return found
+
+
+class FileChunkDocstore(Docstore, AddableMixin):
+    """Documents read from the `file_chunks` table, keyed by chunk id, so chunk text is stored once.
+
+    Recently returned documents are kept in a small LRU cache since follow-up questions hit the same chunks.
+    """
+
+    _batch_size = 500
+
+    def __init__(self, chunk_service: FileChunkService, cache_size: int = 1024):
+        self.chunk_service = chunk_service
+        self.cache_size = cache_size
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        existing = self.chunk_service.find_existing_chunk_ids(list(texts.keys()))
+
+        # numbered after the last chunk of their file by the service
+        chunks = [FileChunk(name=doc.metadata['file_name'], chunk_id=chunk_id, content=doc.page_content)
+                  for chunk_id, doc in texts.items() if chunk_id not in existing]
+        if chunks:
+            self.chunk_service.add_all(chunks)
+
+    def delete(self, ids: List) -> None:
+        with self._lock:
+            for id_ in ids:
+                self._cache.pop(id_, None)
+
+        for i in range(0, len(ids), self._batch_size):
+            self.chunk_service.delete_by_chunk_ids(ids[i:i + self._batch_size])
+
+    def search(self, search: str) -> Union[str, Document]:
+        return self.mget([search]).get(search, f"ID {search} not found.")
+
+    def mget(self, ids: Iterable[str]) -> Dict[str, Document]:
+        found = {}
+        missing = []
+        with self._lock:
+            for id_ in ids:
+                if id_ in self._cache:
+                    self._cache.move_to_end(id_)
+                    found[id_] = self._cache[id_]
+                else:
+                    missing.append(id_)
+
+        if not missing:
+            return found
+
+        loaded = {chunk.chunk_id: Document(page_content=chunk.content, metadata={"file_name": chunk.name})
+                  for chunk in self._find(missing)}
+        found.update(loaded)
+
+        with self._lock:
+            self._cache.update(loaded)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return found
+
+    def _find(self, chunk_ids: List[str]) -> List[FileChunk]:
+        chunks = []
+        for i in range(0, len(chunk_ids), self._batch_size):
+            chunks.extend(self.chunk_service.find_by_chunk_ids(chunk_ids[i:i + self._batch_size]))
+        return chunks
+
+
+class SqliteVectorIdMap:
+    """Two way mapping between the int64 ids stored in the faiss index and docstore ids.
+
+    The file name of each vector is kept as well so that a search can be restricted to the vectors of some files
+    without reading their documents.
+    """
+
+    _batch_size = 500
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS vector_ids "
+                           "(vector_id INTEGER PRIMARY KEY, doc_id TEXT NOT NULL UNIQUE, file_name TEXT)")
+
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(vector_ids)")]
+        if "file_name" not in columns:
+            self._conn.execute("ALTER TABLE vector_ids ADD COLUMN file_name TEXT")
+
+        self._conn.execute("CREATE INDEX IF NOT EXISTS vector_ids_file_name ON vector_ids (file_name, vector_id)")
+        self._conn.commit()
+
+    def next_vector_id(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(vector_id), -1) + 1 FROM vector_ids").fetchone()[0]
+
+    def add(self, vector_ids: List[int], doc_ids: List[str], file_names: List[str] = None):
+        file_names = file_names or [None] * len(doc_ids)
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO vector_ids (vector_id, doc_id, file_name) VALUES (?, ?, ?)",
+                                   zip(map(int, vector_ids), doc_ids, file_names))
+            self._conn.commit()
+
+    def file_vector_ids(self, file_names: List[str]):
+        """Sorted vector ids of the files."""
+        import numpy as np
+
+        rows = self._lookup("SELECT vector_id FROM vector_ids WHERE file_name IN ({})", list(file_names))
+        return np.sort(np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)))
+
+    def all_doc_ids(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT doc_id FROM vector_ids")]
+
+    def without_file_name(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT doc_id FROM vector_ids WHERE file_name IS NULL")]
+
+    def set_file_names(self, file_names: Dict[str, str]):
+        with self._lock:
+            self._conn.executemany("UPDATE vector_ids SET file_name = ? WHERE doc_id = ?",
+                                   [(file_name, doc_id) for doc_id, file_name in file_names.items()])
+            self._conn.commit()
+
+    def delete(self, doc_ids: List[str]) -> Dict[str, int]:
+        """Removes the mappings of `doc_ids` and returns the vector ids they had."""
+        vector_ids = self.vector_ids(doc_ids)
+        with self._lock:
+            self._conn.executemany("DELETE FROM vector_ids WHERE doc_id = ?", [(id_,) for id_ in vector_ids])
+            self._conn.commit()
+        return vector_ids
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def doc_ids(self, vector_ids: Iterable[int]) -> Dict[int, str]:
+        return dict(self._lookup("SELECT vector_id, doc_id FROM vector_ids WHERE vector_id IN ({})",
+                                 [int(vector_id) for vector_id in vector_ids]))
+
+    def vector_ids(self, doc_ids: Iterable[str]) -> Dict[str, int]:
+        return dict(self._lookup("SELECT doc_id, vector_id FROM vector_ids WHERE doc_id IN ({})", list(doc_ids)))
+
+    def live(self, vector_ids: Iterable[int]) -> set:
+        """The vector ids still mapped to a document, without reading the document ids."""
+        return {vector_id for vector_id, in self._lookup("SELECT vector_id FROM vector_ids WHERE vector_id IN ({})",
+                                                         [int(vector_id) for vector_id in vector_ids])}
+
+    def _lookup(self, sql: str, keys: list) -> list:
+        rows = []
+        with self._lock:
+            for i in range(0, len(keys), self._batch_size):
+                batch = keys[i:i + self._batch_size]
+                rows.extend(self._conn.execute(sql.format(",".join("?" * len(batch))), batch).fetchall())
+        return rows
@@ -0,0 +1,237 @@
+import math
+
+FLAT = "flat"
+IVF_FLAT = "ivf_flat"
+IVF_PQ = "ivf_pq"
+HNSW = "hnsw"
+
+INDEX_TYPES = (FLAT, IVF_FLAT, IVF_PQ, HNSW)
+
+# faiss warns when an ivf list gets fewer training points than this
+_min_points_per_list = 39
+_max_training_points = 200_000
+# a promoted store goes back to flat only below this share of promote_at, not on every delete across it
+_demote_ratio = 0.8
+
+
+def _unwrap(index):
+    import faiss
+
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def index_type(index) -> str:
+    import faiss
+
+    index = _unwrap(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return HNSW
+    if isinstance(index, faiss.IndexIVFPQ):
+        return IVF_PQ
+    if isinstance(index, faiss.IndexIVF):
+        return IVF_FLAT
+    return FLAT
+
+
+def target_type(config, ntotal: int, current: str = FLAT) -> str:
+    """Index type a store of `ntotal` vectors should use, stores smaller than `promote_at` stay on flat. A store
+    already on the configured type, `current`, keeps it down to `_demote_ratio` of `promote_at`."""
+    config = config or {}
+    configured = config.get('type', FLAT)
+    if configured not in INDEX_TYPES:
+        raise Exception("Unknown index type:" + str(configured))
+
+    promote_at = config.get('promote_at', 0)
+    if current == configured:
+        promote_at = int(promote_at * _demote_ratio)
+    if ntotal < max(promote_at, _min_training_points(configured, config)):
+        return FLAT
+    return configured
+
+
+def needs_promotion(index, config) -> bool:
+    target = target_type(config, index.ntotal)
+    return target != FLAT and target != index_type(index)
+
+
+def build_index(dims: int, config, vectors=None):
+    """Creates an empty inner product index of the type suited to `vectors`, trained on them if needed."""
+    import faiss
+
+    ntotal = 0 if vectors is None else len(vectors)
+    kind = target_type(config, ntotal)
+    config = config or {}
+
+    if kind == FLAT:
+        index = faiss.IndexFlatIP(dims)
+    elif kind == HNSW:
+        index = faiss.IndexHNSWFlat(dims, config.get('hnsw_m', 32), faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = config.get('ef_construction', 128)
+    else:
+        nlist = _nlist(config, ntotal)
+        quantizer = faiss.IndexFlatIP(dims)
+        if kind == IVF_PQ:
+            index = faiss.IndexIVFPQ(quantizer, dims, nlist, config.get('pq_m', 64), config.get('pq_nbits', 8),
+                                     faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dims, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.own_fields = True
+        quantizer.this.disown()
+
+        index.train(_training_sample(vectors))
+        index.make_direct_map()
+
+    configure_search(index, config)
+    return index
+
+
+def empty_like(index, config):
+    """Empty index of the same type that keeps the ivf training of `index`, which may be memory mapped."""
+    import faiss
+
+    kind = index_type(index)
+    if kind not in (IVF_FLAT, IVF_PQ):
+        return build_index(index.d, (config or {}) | {'type': kind, 'promote_at': 0})
+
+    ivf = faiss.downcast_index(faiss.extract_index_ivf(index))
+    quantizer = faiss.clone_index(ivf.quantizer)
+    if kind == IVF_PQ:
+        new_index = faiss.IndexIVFPQ(quantizer, ivf.d, ivf.nlist, ivf.pq.M, ivf.pq.nbits, ivf.metric_type)
+        faiss.copy_array_to_vector(faiss.vector_to_array(ivf.pq.centroids), new_index.pq.centroids)
+        new_index.is_trained = True
+    else:
+        new_index = faiss.IndexIVFFlat(quantizer, ivf.d, ivf.nlist, ivf.metric_type)
+    new_index.own_fields = True
+    quantizer.this.disown()
+    new_index.make_direct_map()
+
+    configure_search(new_index, config)
+    return new_index
+
+
+def id_mapped(index):
+    import faiss
+    return faiss.IndexIDMap2(index)
+
+
+def configure_search(index, config):
+    """Applies the recall/latency knobs: `nprobe` for ivf indexes and `ef_search` for hnsw."""
+    import faiss
+
+    config = config or {}
+    index = _unwrap(index)
+    kind = index_type(index)
+    if kind in (IVF_FLAT, IVF_PQ):
+        faiss.extract_index_ivf(index).nprobe = config.get('nprobe', 16)
+    elif kind == HNSW:
+        index.hnsw.efSearch = config.get('ef_search', 64)
+
+
+def search_parameters(index, config, selector=None):
+    """Search parameters carrying the knobs of `configure_search`, which faiss ignores once parameters are passed."""
+    import faiss
+
+    config = config or {}
+    kind = index_type(index)
+    if kind in (IVF_FLAT, IVF_PQ):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=config.get('nprobe', 16))
+    if kind == HNSW:
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=config.get('ef_search', 64))
+    return faiss.SearchParameters(sel=selector)
+
+
+def excluding(ids):
+    """Selector matching every id except `ids`. The batch selector is returned too, it must outlive the other."""
+    import faiss
+    import numpy as np
+
+    batch = faiss.IDSelectorBatch(np.fromiter(ids, dtype=np.int64, count=len(ids)))
+    return faiss.IDSelectorNot(batch), batch
+
+
+def selecting(ids):
+    """Selector matching `ids`, a sorted int64 array. A contiguous run, as added for one file, needs no id set."""
+    import faiss
+
+    if ids[-1] - ids[0] + 1 == len(ids):
+        return faiss.IDSelectorRange(int(ids[0]), int(ids[-1]) + 1)
+    return faiss.IDSelectorBatch(ids)
+
+
+def exact_search(index, ids, query, n: int):
+    """Scores the vectors with `ids` exhaustively. Exact for a few vectors where ann search with a selector is not,
+    ivf only visits `nprobe` lists and hnsw loses its graph paths."""
+    import numpy as np
+
+    vectors = index.reconstruct_batch(ids)
+    scores = vectors @ query[0]
+    if n < len(ids):
+        top = np.argpartition(-scores, n)[:n]
+    else:
+        top = np.arange(len(ids))
+    top = top[np.argsort(-scores[top])]
+    return scores[top].reshape(1, -1), ids[top].reshape(1, -1)
+
+
+def all_vectors(index):
+    """Vectors of the index with their ids, positions for indexes that are not id mapped."""
+    import faiss
+    import numpy as np
+
+    if index.ntotal == 0:
+        vectors = np.empty((0, index.d), dtype=np.float32)
+    else:
+        vectors = _unwrap(index).reconstruct_n(0, index.ntotal)
+
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap):
+        ids = faiss.vector_to_array(index.id_map)
+    else:
+        ids = np.arange(index.ntotal, dtype=np.int64)
+
+    return vectors, ids
+
+
+def read_index(path: str, kind: str, mmap: bool):
+    """Reads a base index. Memory mapped indexes are read only, nothing may be added to them."""
+    import faiss
+
+    flags = 0
+    if mmap and kind in (IVF_FLAT, IVF_PQ):
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    elif mmap:
+        # faiss versions before 1.9 cannot map flat codes, they are read into memory there
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", 0) | faiss.IO_FLAG_READ_ONLY
+
+    return faiss.read_index(path, flags)
+
+
+def write_index(index, path: str):
+    import faiss
+    faiss.write_index(index, path)
+
+
+def _min_training_points(kind: str, config) -> int:
+    if kind == IVF_PQ:
+        return _min_points_per_list * 2 ** config.get('pq_nbits', 8)
+    if kind == IVF_FLAT:
+        return _min_points_per_list
+    return 0
+
+
+def _nlist(config, ntotal: int) -> int:
+    nlist = config.get('nlist') or int(4 * math.sqrt(ntotal))
+    return max(1, min(nlist, ntotal // _min_points_per_list))
+
+
+def _training_sample(vectors):
+    import numpy as np
+
+    if len(vectors) <= _max_training_points:
+        return vectors
+
+    rng = np.random.default_rng(0)
+    return vectors[np.sort(rng.choice(len(vectors), _max_training_points, replace=False))]
@@ -0,0 +1,94 @@
+from typing import Any, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from lib.db.model.user_files import UserFile
+from lib.ingest.kvectorstore import KVectorStore
+
+
+class FileRouter:
+    """Picks the files a question is most likely about from embeddings of their summaries, so that the chunk search
+    only covers the vectors of those files however large the library gets."""
+
+    def __init__(self, summary_store: KVectorStore, top_files: int = 20):
+        self.summary_store = summary_store
+        self.top_files = top_files
+
+    def add_file(self, user_file: UserFile):
+        self.summary_store.add_documents([self._summary_document(user_file)], ids=[str(user_file.id)])
+
+    def add_files(self, user_files: List[UserFile]):
+        if user_files:
+            ids = [str(user_file.id) for user_file in user_files]
+            # summaries of files ingested again after an interruption are replaced
+            self.summary_store.delete(ids, ignore_missing=True)
+            self.summary_store.add_documents([self._summary_document(user_file) for user_file in user_files], ids=ids)
+
+    def remove_file(self, user_file: UserFile):
+        self.summary_store.delete([str(user_file.id)])
+
+    def update_file(self, user_file: UserFile):
+        self.remove_file(user_file)
+        self.add_file(user_file)
+
+    def sync(self, user_files: List[UserFile]):
+        """Adds the summaries of files uploaded before routing was enabled and drops the ones of removed files."""
+        stored = set(self.summary_store.vector_store.ids())
+        files = {str(user_file.id): user_file for user_file in user_files}
+
+        removed = list(stored - files.keys())
+        if removed:
+            self.summary_store.delete(removed)
+
+        added = [user_file for id_, user_file in files.items() if id_ not in stored]
+        if added:
+            print(f"Adding {len(added)} file summaries to the file router")
+            self.add_files(added)
+
+    def route(self, query: str) -> Optional[List[str]]:
+        """Names of the files to search, None when the library is small enough to search all of it."""
+        store = self.summary_store.vector_store
+        if store.size() <= self.top_files:
+            return None
+        return self._file_names(store.similarity_search_with_score(query, k=self.top_files))
+
+    def route_by_vector(self, embedding) -> Optional[List[str]]:
+        store = self.summary_store.vector_store
+        if store.size() <= self.top_files:
+            return None
+        return self._file_names(store.similarity_search_with_score_by_vector(embedding, k=self.top_files))
+
+    def retriever(self, retriever) -> "FileRoutingRetriever":
+        return FileRoutingRetriever(router=self, retriever=retriever)
+
+    @staticmethod
+    def _file_names(docs) -> List[str]:
+        return [doc.metadata['file_name'] for doc, _ in docs]
+
+    @staticmethod
+    def _summary_document(user_file: UserFile) -> Document:
+        return Document(page_content=f"{user_file.name}\n{user_file.summary or ''}",
+                        metadata={"file_name": user_file.name})
+
+
+class FileRoutingRetriever(BaseRetriever):
+    """Restricts the dense search of a user file retriever to the files routed to by their summaries. The query is
+    embedded once, for the router and the search."""
+    router: Any
+    retriever: Any
+
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        retriever = self.retriever
+        # a retriever scoped to some files already is used as it is
+        if 'file_name' not in retriever.search_kwargs.get('filter', {}):
+            embedding = retriever.vector_store.embeddings.embed_query(query)
+            search_kwargs = retriever.search_kwargs | {
+                "embedding": embedding, "routed_files": self.router.route_by_vector(embedding)
+            }
+            retriever = retriever.copy(update={"search_kwargs": search_kwargs})
+
+        return retriever._get_relevant_documents(query, run_manager=run_manager)
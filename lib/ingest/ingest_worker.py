@@ -0,0 +1,113 @@
+import threading
+import time
+from typing import Dict, List
+
+from langchain_core.documents import Document
+
+from lib.db.model.ingest_job import IngestJob
+from lib.ingest.ingestion_pipeline import EMBEDDED, INDEXED, IngestFile, IngestionPipeline, PARSED, SAVED, \
+    STAGES, SUMMARIZED
+from lib.service.ingest_job_service import IngestJobService
+
+
+class IngestWorker:
+    """Runs queued ingest jobs in the background through an IngestionPipeline.
+
+    Every file is checkpointed to its job after each stage. Jobs left running by a stopped app are queued again on
+    start and resume from their last checkpoint: chunks, vectors and summaries already made are not made again.
+    """
+
+    def __init__(self, job_service: IngestJobService, pipeline: IngestionPipeline, batch_size: int = 8,
+                 poll_seconds: float = 1.0, threads: int = 1):
+        self.job_service = job_service
+        self.pipeline = pipeline
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+
+        # furthest stage of every file, stages finish out of order and the job shows the furthest one
+        self._stages = {}
+        # jobs queued again after an error, they fail if it happens again
+        self._retried = set()
+        self._threads = [threading.Thread(target=self._run, name=f"ingest-worker-{i}", daemon=True)
+                         for i in range(threads)]
+
+    def start(self):
+        requeued = self.job_service.requeue_running()
+        if requeued:
+            print(f"Resuming {requeued} interrupted ingest jobs")
+
+        for thread in self._threads:
+            thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                jobs = self.job_service.claim(self.batch_size)
+            except Exception as e:
+                print(f"Claiming ingest jobs failed: {e}")
+                jobs = []
+
+            if jobs:
+                self.run_jobs(jobs)
+            else:
+                time.sleep(self.poll_seconds)
+
+    def run_jobs(self, jobs: List[IngestJob]) -> (List[IngestFile], Dict[IngestFile, Exception]):
+        """Runs claimed jobs, returns their files and the errors of the ones that failed."""
+        files = [self._ingest_file(job) for job in jobs]
+        retried = []
+        try:
+            _, failed = self.pipeline.run(files, checkpoint=self._checkpoint)
+        except Exception as e:
+            print(f"Ingest jobs {[job.name for job in jobs]} failed: {e}")
+            # files indexed before the error have their rows and vectors committed, they are queued again to resume
+            # with their summary, once. Only jobs still running are failed, the files saved before the error are done
+            retried = [file for file in files if file.indexed and file.id not in self._retried]
+            self.job_service.requeue([file.id for file in retried])
+            self._retried.update(file.id for file in retried)
+            failed = {file: e for file in files if file not in retried}
+
+        for file, e in failed.items():
+            self.job_service.fail(file.id, str(e))
+        for file in files:
+            self._stages.pop(file.id, None)
+            if file not in retried:
+                self._retried.discard(file.id)
+        return files, failed
+
+    def _ingest_file(self, job: IngestJob) -> IngestFile:
+        import numpy as np
+
+        chunks, vectors = None, None
+        if job.chunks is not None:
+            chunks = [Document(page_content=text, metadata={"file_name": job.name}) for text in job.chunks]
+            if job.vectors is not None:
+                vectors = np.frombuffer(job.vectors, dtype=np.float32).reshape(len(chunks), -1) \
+                    if chunks else np.zeros((0, self.pipeline.vector_store.embeddings.dims), dtype=np.float32)
+
+        self._stages[job.id] = job.stage
+        return IngestFile(job.name, job.data, id=job.id, content=job.content, chunks=chunks, vectors=vectors,
+                          summary=job.summary, indexed=job.stage == INDEXED, content_hash=job.content_hash,
+                          path=job.path)
+
+    def _checkpoint(self, file: IngestFile, stage: str):
+        import numpy as np
+
+        furthest = self._stages.get(file.id)
+        furthest = stage if furthest not in STAGES else max(stage, furthest, key=STAGES.index)
+        self._stages[file.id] = furthest
+
+        if stage == PARSED:
+            # streamed files have no chunks to keep, they are indexed by the time they are parsed
+            self.job_service.checkpoint(file.id, furthest, content=file.content,
+                                        chunks=None if file.chunks is None else [doc.page_content
+                                                                                 for doc in file.chunks])
+        elif stage == EMBEDDED and file.vectors is not None:
+            self.job_service.checkpoint(file.id, furthest,
+                                        vectors=np.ascontiguousarray(file.vectors, np.float32).tobytes())
+        elif stage == SUMMARIZED:
+            self.job_service.checkpoint(file.id, furthest, summary=file.summary)
+        elif stage == SAVED:
+            self.job_service.finish(file.id, stage)
+        else:
+            self.job_service.checkpoint(file.id, furthest)
@@ -0,0 +1,437 @@
+import itertools
+import multiprocessing
+import os
+import threading
+import uuid
+from io import BytesIO
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List
+
+from langchain_core.documents import Document
+
+from lib.db.model.file_chunk import FileChunk
+from lib.db.model.user_files import UserFile
+from lib.ingest.user_file_index_builders import extract_pdf_pages, is_pdf, is_streamable, pdf_page_count, \
+    pdf_page_ranges, split_text, split_user_file, stream_user_file
+from lib.service.file_chunk_service import FileChunkService, content_hash
+from lib.service.user_file_service import UserFileService
+
+PARSED = "parsed"
+EMBEDDED = "embedded"
+SUMMARIZED = "summarized"
+INDEXED = "indexed"
+SAVED = "saved"
+STAGES = (PARSED, EMBEDDED, SUMMARIZED, INDEXED, SAVED)
+
+_PAGE_COUNT = "pdf page count"
+_PAGES = "pdf pages"
+_STREAMED = "streamed"
+
+
+class IngestFile:
+    """An uploaded file going through the pipeline with the results of the stages it is done with, a file resumed
+    from a checkpoint skips them.
+
+    The user file and the chunks get ids derived from `id`, so that a file indexed or saved again after an
+    interruption replaces what the interrupted run wrote.
+    """
+
+    def __init__(self, name: str, data: bytes = None, id: uuid.UUID = None, content: str = None,
+                 chunks: List[Document] = None, vectors=None, summary: str = None, indexed: bool = False,
+                 content_hash: str = None, path: str = None):
+        self.name = name
+        self.data = data
+        # a large file is read from its path as it is ingested instead of held
+        self.path = path
+        self.id = id or uuid.uuid4()
+        self.content_hash = content_hash
+        self.content = content
+        self.chunks = chunks
+        self.vectors = vectors
+        self.summary = summary
+        self.indexed = indexed
+
+    @property
+    def chunk_ids(self) -> List[str]:
+        return [str(uuid.uuid5(self.id, str(i))) for i in range(len(self.chunks))]
+
+    @property
+    def size(self) -> int:
+        return len(self.data) if self.data is not None else os.path.getsize(self.path)
+
+    def open(self):
+        return BytesIO(self.data) if self.data is not None else open(self.path, "rb")
+
+    @property
+    def ready(self) -> bool:
+        # the summary is saved once it is made, the file is searchable before
+        return self.indexed or self.vectors is not None
+
+    def __repr__(self):
+        return f"<IngestFile(name={self.name}, id={self.id})>"
+
+
+class IngestionPipeline:
+    """Ingests uploaded files in overlapping stages, so that a batch of uploads takes about as long as its slowest
+    stage instead of the sum of all of them.
+
+    Files are split into chunks in a process pool kept across runs, the chunks are embedded on one thread pool and summarized on
+    another. Embedded files are saved together: one vector store add for all of their chunks and one transaction for
+    the user files and chunk rows. Their summaries are saved, and the files added to the router, as they come in, a
+    file is searchable before its summary is made. A file whose summary fails is saved without one.
+
+    Chunks already stored, in any file, are not embedded again: their vectors are read back from the vector store. A
+    file uploaded again under its name is updated in place, only its new chunks are added and only the chunks it no
+    longer has removed.
+
+    Text files from `stream_min_bytes` are not held whole: they are read, split, embedded and indexed
+    `stream_batch_size` chunks at a time on an embed worker, the user file keeps the first block of their text the
+    summary is made from. Their chunks are not checkpointed, an interrupted file is streamed again from the start.
+
+    PDF text extraction is the slow part of parsing, the pages of a large PDF are extracted in ranges spread over
+    the process pool and their text then split, embedded and added in one go, like any other file.
+
+    Saving, progress reporting and checkpoints run on the calling thread, Streamlit elements can only be updated from
+    the script thread.
+    """
+
+    def __init__(self, vector_store, file_service: UserFileService, summarize: Callable[[str, List[Document]], str],
+                 router=None, parse_workers: int = 0, embed_workers: int = 2, summary_workers: int = 2,
+                 pdf_min_pages_per_task: int = 8, chunk_service: FileChunkService = None,
+                 stream_min_bytes: int = 32 * 2 ** 20, stream_block_bytes: int = 2 ** 20, stream_batch_size: int = 256):
+        self.vector_store = vector_store
+        self.file_service = file_service
+        # looks up stored chunks by content hash, their vectors are reused
+        self.chunk_service = chunk_service
+        self.summarize = summarize
+        self.router = router
+        # 0 uses a process per core
+        self.parse_workers = parse_workers or os.cpu_count()
+        self.embed_workers = embed_workers
+        self.summary_workers = summary_workers
+        self.pdf_min_pages_per_task = pdf_min_pages_per_task
+        self.stream_min_bytes = stream_min_bytes
+        self.stream_block_bytes = stream_block_bytes
+        self.stream_batch_size = stream_batch_size
+        self._parse_pool = None
+        self._parse_pool_lock = threading.Lock()
+
+        # texts sent to the embeddings, for throughput stats
+        self.embedded_texts = 0
+        self._stats_lock = threading.Lock()
+
+    def run(self, files: List[IngestFile], progress: Callable[[Dict[str, int], int], None] = None,
+            checkpoint: Callable[[IngestFile, str], None] = None) -> (List[UserFile], Dict[IngestFile, Exception]):
+        """Ingests `files`, returns the saved user files and the errors of the files that failed.
+
+        `progress` is called with the count of files done per stage and the file count whenever a stage finishes one,
+        `checkpoint` with a file and the stage it just finished.
+        """
+        done = {stage: 0 for stage in STAGES}
+        saved, failed = [], {}
+        saved_ids = set()
+        # user files saved before their summary was made
+        unsummarized = {}
+
+        def finished_stage(file, stage):
+            done[stage] += 1
+            if checkpoint is not None:
+                checkpoint(file, stage)
+
+        parse_pool = self._parse_executor()
+
+        with ThreadPoolExecutor(self.embed_workers, thread_name_prefix="ingest-embed") as embed_pool, \
+                ThreadPoolExecutor(self.summary_workers, thread_name_prefix="ingest-summary") as summary_pool:
+            pending = {}
+
+            def parse(key, fn, *args):
+                nonlocal parse_pool
+                try:
+                    pending[parse_pool.submit(fn, *args)] = key
+                except BrokenProcessPool:
+                    # a worker died, killed for its memory on some file, the files after it get a new pool
+                    parse_pool = self._parse_executor(broken=parse_pool)
+                    pending[parse_pool.submit(fn, *args)] = key
+
+            def summarize(file):
+                # from the chunks, streamed files have none and are summarized from their first block
+                if file.summary is None:
+                    pending[summary_pool.submit(self.summarize, file.content, file.chunks)] = (SUMMARIZED, file, None)
+                else:
+                    done[SUMMARIZED] += 1
+
+            def embed_and_summarize(file):
+                if file.vectors is None and not file.indexed:
+                    pending[embed_pool.submit(self._embed, file.chunks)] = (EMBEDDED, file, None)
+                else:
+                    done[EMBEDDED] += 1
+
+                summarize(file)
+
+            for file in files:
+                if file.chunks is not None or file.indexed:
+                    # a streamed file checkpointed as indexed has no chunks
+                    done[PARSED] += 1
+                    embed_and_summarize(file)
+                elif self._streams(file):
+                    file.content = self._head(file)
+                    pending[embed_pool.submit(self._stream, file)] = (_STREAMED, file, None)
+                    summarize(file)
+                elif is_pdf(file.name):
+                    # large pdfs are extracted by every parse worker, a page range each
+                    parse((_PAGE_COUNT, file, None), pdf_page_count, file.data)
+                else:
+                    if file.data is None:
+                        with file.open() as stream:
+                            file.data = stream.read()
+                    file.content = file.data.decode("utf-8", errors="replace")
+                    parse((PARSED, file, None), split_user_file, file.name, file.data)
+
+            page_texts = {}
+            while True:
+                ready = [file for file in files if file.ready and file not in failed and file.id not in saved_ids]
+                if ready:
+                    user_files = self._save(ready, finished_stage)
+                    saved.extend(user_files)
+                    saved_ids.update(file.id for file in ready)
+                    unsummarized.update((file.id, user_file) for file, user_file in zip(ready, user_files)
+                                        if file.summary is None)
+
+                summarized = [file for file in files if file.id in unsummarized and file.summary is not None]
+                if summarized:
+                    self._save_summaries(summarized, [unsummarized.pop(file.id) for file in summarized],
+                                         finished_stage)
+
+                if progress is not None:
+                    progress(done, len(files))
+                if not pending:
+                    break
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage, file, part = pending.pop(future)
+                    if file in failed:
+                        continue
+
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        if stage == SUMMARIZED:
+                            # the file is searchable without a summary, one can be written on the Files page
+                            print(f"Summarizing {file.name} failed, it is saved without a summary: {e}")
+                            file.summary = ""
+                            done[SUMMARIZED] += 1
+                            continue
+
+                        print(f"Ingesting {file.name} failed at the {stage} stage: {e}")
+                        failed[file] = e
+                        continue
+
+                    if stage == _STREAMED:
+                        file.indexed = True
+                        for streamed in (PARSED, EMBEDDED, INDEXED):
+                            finished_stage(file, streamed)
+                    elif stage == _PAGE_COUNT:
+                        ranges = pdf_page_ranges(result, self.parse_workers, self.pdf_min_pages_per_task)
+                        page_texts[file] = [None] * len(ranges)
+                        for i, (first, stop) in enumerate(ranges):
+                            parse((_PAGES, file, i), extract_pdf_pages, file.data, first, stop)
+                    elif stage == _PAGES:
+                        page_texts[file][part] = result
+                        if all(texts is not None for texts in page_texts[file]):
+                            texts = [text for texts in page_texts.pop(file) for text in texts]
+                            file.content = "\n".join(texts)
+                            # pages are split on their own like the single process splitter does
+                            file.chunks = [doc for text in texts for doc in split_text(text, file.name)]
+                            finished_stage(file, PARSED)
+                            embed_and_summarize(file)
+                    elif stage == PARSED:
+                        file.chunks = result
+                        finished_stage(file, PARSED)
+                        embed_and_summarize(file)
+                    elif stage == EMBEDDED:
+                        file.vectors = result
+                        finished_stage(file, EMBEDDED)
+                    else:
+                        file.summary = result
+                        finished_stage(file, SUMMARIZED)
+
+        return saved, failed
+
+    def _parse_executor(self, broken: ProcessPoolExecutor = None) -> ProcessPoolExecutor:
+        """The parse pool, made on first use and kept across runs, made again when it is `broken`. Its workers are
+        spawned: a fork copies the memory of the app and the locks its threads hold."""
+        with self._parse_pool_lock:
+            if self._parse_pool is None or self._parse_pool is broken:
+                if self._parse_pool is not None:
+                    self._parse_pool.shutdown(wait=False)
+                self._parse_pool = ProcessPoolExecutor(self.parse_workers,
+                                                       mp_context=multiprocessing.get_context("spawn"))
+            return self._parse_pool
+
+    def close(self):
+        with self._parse_pool_lock:
+            if self._parse_pool is not None:
+                self._parse_pool.shutdown()
+                self._parse_pool = None
+
+    def _embed(self, docs):
+        """Embeddings of `docs`, the ones of chunks stored already, by this or other files, are reused."""
+        import numpy as np
+
+        vectors = np.zeros((len(docs), self.vector_store.embeddings.dims), dtype=np.float32)
+        hashes = [content_hash(doc.page_content) for doc in docs]
+        known = self._stored_vectors(hashes)
+
+        # chunks repeated within the file are embedded once
+        missing = {}
+        for i, (doc, hash_) in enumerate(zip(docs, hashes)):
+            if hash_ in known:
+                vectors[i] = known[hash_]
+            else:
+                missing.setdefault(hash_, (doc.page_content, []))[1].append(i)
+
+        if missing:
+            embedded = self.vector_store.embeddings.embed_documents_matrix([text for text, _ in missing.values()])
+            for vector, (_, rows) in zip(embedded, missing.values()):
+                vectors[rows] = vector
+            with self._stats_lock:
+                self.embedded_texts += len(missing)
+
+        return vectors
+
+    def _streams(self, file: IngestFile) -> bool:
+        return is_streamable(file.name) and file.size >= self.stream_min_bytes
+
+    def _head(self, file: IngestFile) -> str:
+        with file.open() as stream:
+            return stream.read(self.stream_block_bytes).decode("utf-8", errors="ignore")
+
+    def _stream(self, file: IngestFile):
+        """Splits, embeds and indexes a file a batch of chunks at a time, then removes the chunks of the file it
+        replaces. A failed file takes its chunks out again."""
+        # the chunks of the file replaced are numbered before the new ones
+        first_idx = self.chunk_service.next_chunk_idx(file.name) if self.chunk_service is not None else None
+
+        added = 0
+        try:
+            with file.open() as stream:
+                chunks = stream_user_file(file.name, stream, self.stream_block_bytes)
+                while True:
+                    docs = list(itertools.islice(chunks, self.stream_batch_size))
+                    if not docs:
+                        break
+
+                    ids = [str(uuid.uuid5(file.id, str(i))) for i in range(added, added + len(docs))]
+                    # chunks an interrupted run of the file got to add are replaced
+                    self.vector_store.delete(ids, ignore_missing=True)
+                    self.vector_store.add_embedded(docs, self._embed(docs), ids)
+                    added += len(docs)
+        except Exception:
+            self.vector_store.delete([str(uuid.uuid5(file.id, str(i))) for i in range(added)], ignore_missing=True)
+            raise
+
+        if first_idx:
+            replaced = [chunk.chunk_id for chunk in self.chunk_service.find_file_chunks(file.name)
+                        if chunk.idx < first_idx]
+            self.vector_store.delete(replaced, ignore_missing=True)
+
+    def _stored_vectors(self, hashes: List[str]) -> dict:
+        if self.chunk_service is None or not hashes:
+            return {}
+
+        chunk_ids = self.chunk_service.find_chunk_ids_by_content_hashes(list(set(hashes)))
+        vectors = self.vector_store.get_vectors(list(chunk_ids.values()))
+        return {hash_: vectors[chunk_id] for hash_, chunk_id in chunk_ids.items() if chunk_id in vectors}
+
+    def _save(self, files: List[IngestFile], finished_stage) -> List[UserFile]:
+        import numpy as np
+
+        # a file uploaded again under its name is updated in place, keeping its id and its unchanged chunks
+        previous = {user_file.name: user_file for user_file in self.file_service.find_by_names([f.name for f in files])}
+
+        indexing = [file for file in files if not file.indexed]
+        docs, vectors, ids, idxs, removed_ids = [], [], [], [], []
+        # chunk rows are numbered by their position in the file, kept chunks move to theirs in the new version
+        kept_idxs = {}
+        for file in indexing:
+            kept, file_removed_ids = self._diff(file) if file.name in previous else ({}, [])
+            removed_ids.extend(file_removed_ids)
+            kept_idxs.update((chunk_id, i) for i, chunk_id in kept.items())
+            for i, (doc, chunk_id) in enumerate(zip(file.chunks, file.chunk_ids)):
+                if i not in kept:
+                    docs.append(doc)
+                    vectors.append(file.vectors[i])
+                    ids.append(chunk_id)
+                    idxs.append(i)
+
+        if ids:
+            # chunks an interrupted run of a resumed file got to add are replaced
+            self.vector_store.delete(ids, ignore_missing=True)
+            # the chunk rows are written with the user files below
+            self.vector_store.add_embedded(docs, np.vstack(vectors), ids, store_documents=False)
+
+        # the vectors are added first and taken out again if the transaction fails, and a file whose transaction
+        # committed is not indexed again when resumed, its chunks are all found by _diff
+        try:
+            user_files = self.file_service.save_all(
+                [UserFile(id=previous[file.name].id if file.name in previous else file.id, name=file.name,
+                          content=file.content, summary=file.summary, content_hash=file.content_hash)
+                 for file in files],
+                [FileChunk(name=doc.metadata['file_name'], idx=idx, chunk_id=chunk_id, content=doc.page_content)
+                 for doc, chunk_id, idx in zip(docs, ids, idxs)],
+                removed_ids + ids, kept_idxs)
+        except Exception:
+            if ids:
+                self.vector_store.delete(ids, ignore_missing=True)
+            raise
+
+        if ids:
+            # searches between the add and the commit found the vectors without their chunk rows
+            self.vector_store.touch()
+        if removed_ids:
+            self.vector_store.delete(removed_ids, ignore_missing=True)
+        for file in indexing:
+            file.indexed = True
+            finished_stage(file, INDEXED)
+
+        # files without a summary yet are routed by their name until it is saved
+        if self.router is not None:
+            self.router.add_files(user_files)
+
+        for file in files:
+            if file.summary is not None:
+                finished_stage(file, SAVED)
+        return user_files
+
+    def _save_summaries(self, files: List[IngestFile], user_files: List[UserFile], finished_stage):
+        for file, user_file in zip(files, user_files):
+            user_file.summary = file.summary
+        self.file_service.update_summaries({user_file.id: user_file.summary for user_file in user_files})
+
+        if self.router is not None:
+            self.router.add_files(user_files)
+
+        for file in files:
+            finished_stage(file, SAVED)
+
+    def _diff(self, file: IngestFile) -> (Dict[int, str], List[str]):
+        """Ids of the chunks of `file` stored already under its name by their position in it, and the ids of the
+        stored chunks it no longer has, so that re-indexing a changed file costs the size of the change."""
+        stored = {}
+        if self.chunk_service is not None:
+            chunks = self.chunk_service.find_file_chunks(file.name)
+            # chunks whose vector an interrupted run did not get to add are added again
+            indexed = self.vector_store.existing_ids([chunk.chunk_id for chunk in chunks])
+            for chunk in chunks:
+                if chunk.chunk_id in indexed and chunk.content_hash is not None:
+                    stored.setdefault(chunk.content_hash, []).append(chunk.chunk_id)
+
+        kept = {}
+        for i, doc in enumerate(file.chunks):
+            chunk_ids = stored.get(content_hash(doc.page_content))
+            if chunk_ids:
+                kept[i] = chunk_ids.pop()
+
+        return kept, [chunk_id for chunk_ids in stored.values() for chunk_id in chunk_ids]
@@ -1,23 +1,34 @@
-from typing import List, Iterable
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Iterable, Optional
 
-from langchain.embeddings import CacheBackedEmbeddings
-from langchain.storage import LocalFileStore
+import requests
 from langchain_core.embeddings import Embeddings
+from requests.adapters import HTTPAdapter
 
+from lib.utils.sqlite_cache import SqliteLruCache
 
-def ollama_embeddings(config) -> (Embeddings, int):
-    from langchain_community.embeddings import OllamaEmbeddings
 
+def ollama_embeddings(config) -> (Embeddings, int):
     model = config['model']
     dimensions = config['dimensions']
     base_url = config['base_url']
 
-    return NormalizedEmbeddings(OllamaEmbeddings(model=model, base_url=base_url)), dimensions
+    embeddings = OllamaBatchEmbeddings(
+        model=model, base_url=base_url,
+        batch_size=config.get('batch_size', 32),
+        max_concurrency=config.get('max_concurrency', 4),
+        timeout=config.get('timeout', 120),
+        log_throughput=config.get('log_throughput', False)
+    )
 
+    return NormalizedEmbeddings(embeddings), dimensions
 
-def get_file_cached_embeddings(task, provider, model, backing_embeddings) -> Embeddings:
-    store = LocalFileStore(f"data/embeddings/{task}/{provider}/{model}-")
-    return CacheBackedEmbeddings.from_bytes_store(backing_embeddings, store, namespace=model)
+
+def sqlite_cached_embeddings(config, namespace, backing_embeddings) -> Embeddings:
+    cache = SqliteLruCache.shared(config['path'], config['max_entries'], table="embeddings")
+    return CachedEmbeddings(backing_embeddings, cache, namespace=namespace)
 
 
 class KEmbeddings(Embeddings):
@@ -28,22 +39,170 @@ class KEmbeddings(Embeddings):
         else:
             raise Exception("Unknown embeddings!:" + str(provider))
 
+        if config.get('cache'):
+            namespace = f"{provider}/{config['model']}"
+            self.embeddings = sqlite_cached_embeddings(config['cache'], namespace, self.embeddings)
+
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         return self.embeddings.embed_documents(texts)
 
+    def embed_documents_matrix(self, texts: List[str]) -> "np.ndarray":
+        return self.embeddings.embed_documents_matrix(texts)
+
     def embed_query(self, text: str) -> List[float]:
         return self.embeddings.embed_query(text)
 
+    def cache_stats(self) -> Optional[dict]:
+        """Hits and misses of the embedding cache, None without one."""
+        return self.embeddings.cache.stats() if isinstance(self.embeddings, CachedEmbeddings) else None
+
 
 class NormalizedEmbeddings(Embeddings):
     def __init__(self, embeddings):
         self.embeddings = embeddings
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        return [norm_embed(emb) for emb in self.embeddings.embed_documents(texts)]
+        return list(self.embed_documents_matrix(texts)) if texts else []
+
+    def embed_documents_matrix(self, texts: List[str]) -> "np.ndarray":
+        return norm_embed_batch(self.embeddings.embed_documents(texts))
 
     def embed_query(self, text: str) -> List[float]:
-        return norm_embed(self.embeddings.embed_query(text))
+        return norm_embed_batch([self.embeddings.embed_query(text)])[0]
+
+
+class CachedEmbeddings(Embeddings):
+    """Looks embeddings up by model and content hash before delegating the misses to the backing embeddings."""
+
+    def __init__(self, embeddings, cache: SqliteLruCache, namespace: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.namespace = namespace
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+
+        return self._embed("document", texts)
+
+    def embed_documents_matrix(self, texts: List[str]) -> "np.ndarray":
+        import numpy as np
+        return np.vstack(self.embed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed("query", [text])[0]
+
+    def _embed(self, kind, texts):
+        import numpy as np
+
+        keys = [self._key(kind, text) for text in texts]
+        vectors = {key: np.frombuffer(value, dtype=np.float32) for key, value in self.cache.get_many(keys).items()}
+
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if missing:
+            missing_texts = list(missing.values())
+            if kind == "query":
+                embs = [self.embeddings.embed_query(text) for text in missing_texts]
+            elif hasattr(self.embeddings, "embed_documents_matrix"):
+                embs = self.embeddings.embed_documents_matrix(missing_texts)
+            else:
+                embs = self.embeddings.embed_documents(missing_texts)
+
+            embedded = {key: np.asarray(emb, dtype=np.float32) for key, emb in zip(missing.keys(), embs)}
+            self.cache.put_many({key: emb.tobytes() for key, emb in embedded.items()})
+            vectors.update(embedded)
+
+        return [vectors[key] for key in keys]
+
+    def _key(self, kind, text):
+        return hashlib.sha256(f"{self.namespace}\0{kind}\0{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingStats:
+    def __init__(self):
+        self.texts = 0
+        self.seconds = 0.0
+
+    def record(self, texts: int, seconds: float):
+        self.texts += texts
+        self.seconds += seconds
+
+    @property
+    def texts_per_sec(self) -> float:
+        return self.texts / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        return f"<EmbeddingStats(texts={self.texts}, seconds={self.seconds:.2f}, texts_per_sec={self.texts_per_sec:.1f})>"
+
+
+class OllamaBatchEmbeddings(Embeddings):
+    """Ollama embeddings sent in batches over a pool of keep-alive connections.
+
+    Batches go to the `/api/embed` endpoint, at most `max_concurrency` of them in flight. Ollama versions without
+    that endpoint are served through the legacy one-text-per-request `/api/embeddings` endpoint on the same pool.
+    """
+
+    def __init__(self, model: str, base_url: str, batch_size: int = 32, max_concurrency: int = 4, timeout=120,
+                 log_throughput: bool = False):
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.batch_size = max(1, batch_size)
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+        self.stats = EmbeddingStats()
+        self.log_throughput = log_throughput
+
+        self._legacy_api = False
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="ollama-embed")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+
+        start = time.perf_counter()
+
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        embeddings = [emb for batch_embeddings in self._executor.map(self._embed_batch, batches)
+                      for emb in batch_embeddings]
+
+        elapsed = time.perf_counter() - start
+        self.stats.record(len(texts), elapsed)
+        if self.log_throughput:
+            print(f"Embedded {len(texts)} texts in {len(batches)} batches, {elapsed:.2f}s "
+                  f"({len(texts) / max(elapsed, 1e-9):.1f} texts/s, overall {self.stats.texts_per_sec:.1f} texts/s)")
+
+        return embeddings
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed_batch([text])[0]
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        if not self._legacy_api:
+            res = self._post("/api/embed", {"model": self.model, "input": texts})
+            if res.status_code != 404:
+                return self._parse(res, "embeddings")
+
+            if not self._legacy_api:
+                print("Ollama /api/embed is not available, falling back to /api/embeddings")
+                self._legacy_api = True
+
+        return [self._parse(self._post("/api/embeddings", {"model": self.model, "prompt": text}), "embedding")
+                for text in texts]
+
+    def _post(self, path: str, payload: dict) -> requests.Response:
+        try:
+            return self._session.post(self.base_url + path, json=payload, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            raise ValueError(f"Error raised by inference endpoint: {e}")
+
+    def _parse(self, res: requests.Response, key: str):
+        if res.status_code != 200:
+            raise ValueError(f"Error raised by inference API HTTP code: {res.status_code}, {res.text}")
+        return res.json()[key]
 
 
 def norm_embed(emb: Iterable[float]):
@@ -51,3 +210,12 @@ def norm_embed(emb: Iterable[float]):
     arr_emb = np.array(emb)
     magnitude = np.linalg.norm(arr_emb)
     return arr_emb / magnitude
+
+
+def norm_embed_batch(embs: Iterable[Iterable[float]]) -> "np.ndarray":
+    """L2 normalizes the rows of `embs` into a single C-contiguous float32 matrix."""
+    import numpy as np
+    matrix = np.array(embs, dtype=np.float32, order="C", ndmin=2)
+    magnitudes = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, magnitudes, out=matrix, where=magnitudes > 0)
+    return matrix
@@ -1,101 +1,1122 @@
+import json
 import os
+import threading
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Any
 
 from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_core.callbacks import CallbackManagerForRetrieverRun
 from langchain_core.documents import Document
 from langchain_core.retrievers import BaseRetriever
-from langchain_core.vectorstores import VectorStore
 
+from lib.ingest import faiss_index, rerank
+from lib.ingest.delta_log import DeltaLog
+from lib.ingest.docstores import SqliteDocstore, SqliteVectorIdMap
 from lib.ingest.kembeddings import KEmbeddings
+from lib.ingest.lexical_index import LexicalIndex
+from lib.ingest.store_lock import lock_store, unlock_store
+from lib.utils.lru_cache import LruCache
 
 
 class KVectorStore:
-    def __init__(self, embeddings: KEmbeddings, task, config):
+    def __init__(self, embeddings: KEmbeddings, task, config, docstore=None):
         provider = config['provider']
-        if provider == "faiss":
-            self.vector_store = KFaissVectorStore(embeddings, task)
+        if provider == "faiss" and config.get('sharding', {}).get('enabled'):
+            self.vector_store = KShardedFaissVectorStore(embeddings, task, config, docstore)
+        elif provider == "faiss":
+            self.vector_store = KFaissVectorStore(embeddings, task, config, docstore)
+            KShardedFaissVectorStore.unshard(self.vector_store, task, config, docstore)
         else:
             raise Exception("Unknown provider:" + str(provider))
 
     def add_documents(self, documents: List[Document], **kwargs: Any) -> List[str]:
         return self.vector_store.add_documents(documents, **kwargs)
 
-    def get_user_file_retriever(self, k=10):
-        return self.vector_store.get_user_file_retriever(k)
+    def add_embedded(self, documents: List[Document], matrix, ids: List[str] = None,
+                     store_documents: bool = True) -> List[str]:
+        return self.vector_store.add_embedded(documents, matrix, ids, store_documents)
 
-    def delete(self, ids: List[str]):
+    @property
+    def embeddings(self) -> KEmbeddings:
+        return self.vector_store.embeddings
+
+    def get_vectors(self, ids: List[str]) -> dict:
+        return self.vector_store.get_vectors(ids)
+
+    def existing_ids(self, ids: List[str]) -> set:
+        return self.vector_store.existing_ids(ids)
+
+    def get_user_file_retriever(self, k=10, file_names=None, **search_kwargs):
+        return self.vector_store.get_user_file_retriever(k, file_names, **search_kwargs)
+
+    def result_cache_stats(self) -> dict:
+        return self.vector_store.result_cache.stats()
+
+    def touch(self):
+        self.vector_store.touch()
+
+    def delete(self, ids: List[str], ignore_missing: bool = False):
         try:
-            self.vector_store.delete(ids)
+            self.vector_store.delete(ids, ignore_missing)
         except ValueError as e:
             print(e)
 
 
 class KFaissVectorStore:
+    """A named faiss store persisted under `.faiss`.
+
+    Vectors live in two segments: a base index written at compaction, opened memory mapped and never modified, and a
+    small in-memory delta index holding the changes recorded in the delta log since. Documents and the mapping between
+    faiss ids and document ids are kept in SQLite and only read for search hits. The document text can be kept
+    elsewhere by passing a `docstore`, the user file store reads it from the `file_chunks` table.
+    """
     store_root = ".faiss"
     store_dir = ".faiss_{name}"
+    checkpoint_file = "checkpoint.json"
+    delta_log_file = "vectors.log"
+    sqlite_file = "store.sqlite"
+    lock_file = "lock"
+    layout = 2
+    # an ivf base keeps its training until the store grows this many times past the vectors it was trained on
+    retrain_growth = 4
+    # searches restricted to at most this many ann indexed vectors score them exactly
+    exact_search_max = 10000
 
-    def __init__(self, embeddings: KEmbeddings, name: str):
+    def __init__(self, embeddings: KEmbeddings, name: str, config=None, docstore=None):
+        config = config or {}
+        self.index_config = config.get('index', {})
+        self.mmap = config.get('mmap', True)
 
-        from langchain_community.vectorstores.faiss import DistanceStrategy
-        from langchain_community.vectorstores.faiss import FAISS
-        import faiss
-        import os
+        persistence = config.get('persistence', {})
+        self.compact_threshold = persistence.get('compact_threshold', 20000)
+        self.background_compaction = persistence.get('background_compaction', True)
+        self.tombstone_ratio = persistence.get('tombstone_ratio', 0.2)
+
+        self.hybrid = config.get('hybrid', {})
+        self.retrieval = config.get('retrieval', {})
+
+        # searches by query text are cached until the next add or delete bumps the version
+        self.version = 0
+        self.result_cache = LruCache(config.get('result_cache', {}).get('max_entries', 256))
 
         self.embeddings = embeddings
         self.store_path = os.path.join(self.store_root, self.store_dir.format(name=name))
+        os.makedirs(self.store_path, exist_ok=True)
+        # vector ids are handed out in memory, a second process writing the store would reuse them
+        lock_store(os.path.join(self.store_path, self.lock_file))
 
-        if os.path.exists(self.store_path):
-            self.vector_store = FAISS.load_local(
-                self.store_path, self.embeddings, allow_dangerous_deserialization=True,
-                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
-            )
+        self._lock = threading.RLock()
+        self._persist_lock = threading.Lock()
+        self._compaction = None
+
+        sqlite_path = os.path.join(self.store_path, self.sqlite_file)
+        self.docstore = docstore if docstore is not None else SqliteDocstore(sqlite_path)
+        self.id_map = SqliteVectorIdMap(sqlite_path)
+        self.lexical_index = LexicalIndex(sqlite_path, self.hybrid.get('max_term_ratio', 0.02)) \
+            if self.hybrid.get('enabled') else None
+        self.delta_log = DeltaLog(os.path.join(self.store_path, self.delta_log_file))
+
+        self.base_index = None
+        self._base_name = None
+        self.delta_index = faiss_index.id_mapped(faiss_index.build_index(self.embeddings.dims, None))
+        # ids deleted from the base since it was written, filtered out at query time until the next compaction
+        self._tombstones = set()
+        self._tombstone_selector = None
+        self._base_next_vector_id = 0
+        self._next_vector_id = 0
+
+        checkpoint = self._read_checkpoint()
+        if checkpoint is not None and checkpoint.get('layout') != self.layout:
+            self._migrate(checkpoint)
         else:
-            self.vector_store = FAISS(
-                embedding_function=self.embeddings, index=faiss.IndexFlatIP(self.embeddings.dims),
-                docstore=InMemoryDocstore(), index_to_docstore_id={},
-                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
-            )
+            checkpoint = checkpoint or {"seq": 0}
+            self._open_base(checkpoint)
+            self._replay(checkpoint['seq'])
 
-            self.persist()
+        self._next_vector_id = max(self._next_vector_id, self.id_map.next_vector_id())
+        self._label_file_names()
+        self._sync_lexical_index()
 
     def add_documents(self, documents: List[Document], **kwargs: Any) -> List[str]:
-        ids = self.vector_store.add_documents(documents, **kwargs)
-        self.persist()
+        if not documents:
+            return []
+
+        matrix = self.embeddings.embed_documents_matrix([doc.page_content for doc in documents])
+        return self.add_embedded(documents, matrix, kwargs.get('ids'))
+
+    def add_embedded(self, documents: List[Document], matrix, ids: List[str] = None,
+                     store_documents: bool = True) -> List[str]:
+        """Adds documents with their normalized float32 embedding matrix.
+
+        `store_documents` False leaves the docstore to the caller, which writes the documents in its own transaction.
+        """
+        import numpy as np
+
+        ids = ids or [str(uuid.uuid4()) for _ in documents]
+
+        with self._lock:
+            vector_ids = np.arange(self._next_vector_id, self._next_vector_id + len(ids), dtype=np.int64)
+            self._next_vector_id += len(ids)
+
+            if store_documents:
+                self.docstore.add(dict(zip(ids, documents)))
+            self.id_map.add(vector_ids, ids, [doc.metadata.get('file_name', '') for doc in documents])
+            if self.lexical_index is not None:
+                self.lexical_index.add(vector_ids, [doc.page_content for doc in documents])
+            self.delta_index.add_with_ids(matrix, vector_ids)
+            self.delta_log.append({"op": "add", "ids": ids, "vector_ids": vector_ids, "vectors": matrix})
+            self.version += 1
+
+        self._maybe_compact()
         return ids
 
+    def delete(self, ids: List[str], ignore_missing: bool = False):
+        import numpy as np
+
+        with self._lock:
+            vector_ids = self.id_map.vector_ids(ids)
+            missing = set(ids) - set(vector_ids)
+            if missing and not ignore_missing:
+                raise ValueError(f"Some specified ids do not exist in the current store. Ids not found: {missing}")
+            if not vector_ids:
+                return
+
+            ids = list(vector_ids)
+            vector_ids = np.fromiter(vector_ids.values(), dtype=np.int64, count=len(vector_ids))
+            self.id_map.delete(ids)
+            self.docstore.delete(ids)
+            if self.lexical_index is not None:
+                self.lexical_index.delete(vector_ids)
+            self._remove_vectors(vector_ids)
+            self.delta_log.append({"op": "delete", "ids": ids, "vector_ids": vector_ids})
+            self.version += 1
+
+        self._maybe_compact()
+
+    def touch(self):
+        """Drops the cached searches, for documents written by the caller after `add_embedded` without them."""
+        with self._lock:
+            self.version += 1
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter=None, fetch_k: int = 20, embedding=None,
+                                     **kwargs):
+        """`embedding` is the one of `query` when the caller has it already."""
+        def search():
+            vector = embedding if embedding is not None else self.embeddings.embed_query(query)
+            return self.similarity_search_with_score_by_vector(vector, k, filter=filter, fetch_k=fetch_k, **kwargs)
+
+        return _cached_search(self.result_cache, self.version, "dense", query,
+                              dict(kwargs, k=k, filter=filter, fetch_k=fetch_k), search)
+
+    def similarity_search_with_score_by_vector(self, embedding, k: int = 4, filter=None, fetch_k: int = 20,
+                                               score_threshold=None, lambda_mult=None, dedup_threshold=None,
+                                               routed_files=None, **kwargs):
+        """`dedup_threshold` drops candidates too similar to a better one and `lambda_mult` picks the results by mmr,
+        both from the `fetch_k` best candidates. `routed_files` limits the search to the files picked by a FileRouter."""
+        import numpy as np
+
+        query = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+
+        # file names are known to the id map, only the other keys are checked on the documents
+        filter, file_names = _split_filter(filter)
+        file_names = _routed(file_names, routed_files)
+        diversify = lambda_mult is not None or dedup_threshold is not None
+        n = fetch_k if filter or diversify else k
+
+        hits = self._dense_hits(query, n, file_names)
+        docs = self._documents(hits, filter, n)
+
+        if score_threshold is not None:
+            docs = [doc for doc in docs if doc[1] >= score_threshold]
+        if diversify:
+            docs = _diversify(query[0], docs, self._vectors([vector_id for _, _, vector_id in docs]), k,
+                              lambda_mult, dedup_threshold)
+
+        return [(doc, score) for doc, score, _ in docs[:k]]
+
+    def hybrid_search_with_score(self, query: str, k: int = 4, filter=None, fetch_k: int = 20,
+                                 score_threshold=None, lambda_mult=None, dedup_threshold=None, embedding=None,
+                                 routed_files=None, **kwargs):
+        """Fuses the dense and the bm25 rankings with reciprocal rank fusion, scores are the fused ones.
+
+        `score_threshold` drops weak dense hits only, a chunk found by exact words is kept however far it is. So does
+        `routed_files`, the files picked by a FileRouter from their summaries: bm25 searches every file, as the words
+        asked for may be in a file whose summary does not mention them.
+        """
+        if not self.hybrid_enabled:
+            raise ValueError("Hybrid search is not enabled for " + self.store_path)
+
+        search_kwargs = dict(k=k, filter=filter, fetch_k=fetch_k, score_threshold=score_threshold,
+                             lambda_mult=lambda_mult, dedup_threshold=dedup_threshold, routed_files=routed_files)
+        return _cached_search(self.result_cache, self.version, "hybrid", query, search_kwargs,
+                              lambda: self._hybrid_search(query, embedding, **search_kwargs))
+
+    def _hybrid_search(self, query: str, embedding, k, filter, fetch_k, score_threshold, lambda_mult, dedup_threshold,
+                       routed_files):
+        import numpy as np
+
+        filter, file_names = _split_filter(filter)
+        rrf_k = self.hybrid.get('rrf_k', 60)
+
+        if embedding is None:
+            embedding = self.embeddings.embed_query(query)
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        dense = self._dense_hits(embedding, fetch_k, _routed(file_names, routed_files))
+        if score_threshold is not None:
+            dense = [hit for hit in dense if hit[0] >= score_threshold]
+        lexical = self.lexical_index.search(query, fetch_k, file_names)
+
+        hits = _fuse([dense, lexical], rrf_k)
+        if lambda_mult is not None or dedup_threshold is not None:
+            docs = self._documents(hits, filter, len(hits))
+            docs = _diversify(embedding[0], docs, self._vectors([vector_id for _, _, vector_id in docs]), k,
+                              lambda_mult, dedup_threshold)
+        else:
+            docs = self._documents(hits, filter, k)
+
+        return [(doc, score) for doc, score, _ in docs[:k]]
+
+    def _dense_hits(self, query, n, file_names):
+        if file_names is None:
+            hits = self._search_all(query, n)
+        else:
+            hits = self._search_files(file_names, query, n)
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        return hits
+
+    def _documents(self, hits, filter, n):
+        doc_ids = self.id_map.doc_ids([vector_id for _, vector_id in hits])
+        documents = self.docstore.mget(doc_ids.values())
+
+        docs = []
+        for score, vector_id in hits:
+            doc = documents.get(doc_ids.get(vector_id))
+            if doc is None:
+                continue
+            if filter and not _metadata_matches(doc.metadata, filter):
+                continue
+            docs.append((doc, score, vector_id))
+            if len(docs) == n:
+                break
+
+        return docs
+
+    def get_vectors(self, ids: List[str]) -> dict:
+        """Stored embeddings by document id, ids not in the store are left out.
+
+        So are the ids in a product quantized base, its reconstructions are approximations that would be stored as the
+        embeddings of new chunks and trained on by the next compaction."""
+        vector_ids = self.id_map.vector_ids(ids)
+        with self._lock:
+            if self._base_type() == faiss_index.IVF_PQ:
+                vector_ids = {id_: vector_id for id_, vector_id in vector_ids.items()
+                              if vector_id >= self._base_next_vector_id}
+        vectors = self._vectors(list(vector_ids.values())) if vector_ids else None
+        if vectors is None:
+            return {}
+        return dict(zip(vector_ids.keys(), vectors))
+
+    def existing_ids(self, ids: List[str]) -> set:
+        return set(self.id_map.vector_ids(ids))
+
+    def _vectors(self, vector_ids):
+        import numpy as np
+
+        vector_ids = np.asarray(vector_ids, dtype=np.int64)
+        vectors = np.empty((len(vector_ids), self.embeddings.dims), dtype=np.float32)
+
+        with self._lock:
+            in_delta = vector_ids >= self._base_next_vector_id
+            try:
+                if in_delta.any():
+                    vectors[in_delta] = self.delta_index.reconstruct_batch(vector_ids[in_delta])
+                if not in_delta.all():
+                    vectors[~in_delta] = self.base_index.reconstruct_batch(vector_ids[~in_delta])
+            except RuntimeError as e:
+                # deleted after the search found it, the results are returned as they are
+                print(e)
+                return None
+
+        return vectors
+
+    @property
+    def hybrid_enabled(self) -> bool:
+        return self.lexical_index is not None
+
+    def _search_all(self, query, n):
+        with self._lock:
+            base = self.base_index
+            # the selector is held until the search returns, deletes and compaction replace the store's one
+            params, selector = self._base_search_parameters()
+            hits = self._search(self.delta_index, query, n)
+
+        hits.extend(self._search(base, query, n, params))
+        return hits
+
+    def _search_files(self, file_names, query, n):
+        """Searches only the vectors of `file_names`, selected by id inside faiss."""
+        import numpy as np
+
+        vector_ids = self.id_map.file_vector_ids(file_names)
+        if not len(vector_ids):
+            return []
+
+        with self._lock:
+            base = self.base_index
+            split = np.searchsorted(vector_ids, self._base_next_vector_id)
+            hits = []
+            if split < len(vector_ids):
+                selector = faiss_index.selecting(vector_ids[split:])
+                params = faiss_index.search_parameters(self.delta_index, None, selector)
+                hits = self._search(self.delta_index, query, n, params)
+
+        base_ids = vector_ids[:split]
+        if base is None or not len(base_ids):
+            return hits
+
+        if faiss_index.index_type(base) != faiss_index.FLAT and len(base_ids) <= self.exact_search_max:
+            scores, found = faiss_index.exact_search(base, base_ids, query, n)
+            hits.extend((float(score), int(vector_id)) for score, vector_id in zip(scores[0], found[0]))
+        else:
+            selector = faiss_index.selecting(base_ids)
+            hits.extend(self._search(base, query, n, faiss_index.search_parameters(base, self.index_config, selector)))
+
+        return hits
+
+    @staticmethod
+    def _search(index, query, n, params=None):
+        if index is None or index.ntotal == 0:
+            return []
+
+        scores, vector_ids = index.search(query, min(n, index.ntotal), params=params)
+        return [(float(score), int(vector_id)) for score, vector_id in zip(scores[0], vector_ids[0])
+                if vector_id != -1]
+
+    def _base_search_parameters(self):
+        """Search parameters of the base index and the tombstone selector they point to. The parameters keep no
+        reference to the selector, the caller must hold it for as long as it searches with them."""
+        if self.base_index is None:
+            return None, None
+
+        if self._tombstones and self._tombstone_selector is None:
+            self._tombstone_selector = faiss_index.excluding(self._tombstones)
+
+        selector = self._tombstone_selector if self._tombstones else None
+        return faiss_index.search_parameters(self.base_index, self.index_config,
+                                             selector[0] if selector else None), selector
+
+    def _remove_vectors(self, vector_ids):
+        import faiss
+
+        in_base = [int(vector_id) for vector_id in vector_ids if vector_id < self._base_next_vector_id]
+        in_delta = [int(vector_id) for vector_id in vector_ids if vector_id >= self._base_next_vector_id]
+
+        if in_delta:
+            self.delta_index.remove_ids(faiss.IDSelectorBatch(in_delta))
+        if in_base:
+            self._tombstones.update(in_base)
+            self._tombstone_selector = None
+
     def persist(self):
-        if not os.path.exists(self.store_root):
-            os.mkdir(self.store_root)
+        """Writes the base and delta segments into a new base and drops the delta log records it contains."""
+        with self._persist_lock:
+            self._persist()
+
+    def _persist(self):
+        import faiss
+        import numpy as np
+
+        with self._lock:
+            seq = self.delta_log.last_seq
+            base = self.base_index
+            base_name = self._base_name
+            tombstones = set(self._tombstones)
+            delta_vectors, delta_ids = faiss_index.all_vectors(self.delta_index)
+            next_vector_id = self._next_vector_id
+
+        checkpoint = self._read_checkpoint() or {}
+
+        if base is not None:
+            base_vectors, base_ids = self._base_vectors(base, base_name)
+            vectors = np.concatenate([base_vectors, delta_vectors])
+            ids = np.concatenate([base_ids, delta_ids])
+        else:
+            vectors, ids = delta_vectors, delta_ids
+
+        live = np.fromiter(self.id_map.live(ids), dtype=np.int64)
+        keep = np.isin(ids, live)
+        vectors, ids = vectors[keep], ids[keep]
+
+        kind = faiss_index.target_type(self.index_config, len(vectors),
+                                       faiss_index.index_type(base) if base is not None else faiss_index.FLAT)
+        trained_on = checkpoint.get('trained_on', 0)
+        if (base is not None and kind == faiss_index.index_type(base) and kind != faiss_index.FLAT
+                and len(vectors) < self.retrain_growth * trained_on):
+            index = faiss_index.empty_like(base, self.index_config)
+        else:
+            if kind != faiss_index.FLAT:
+                print(f"Training {kind} index of {self.store_path} on {len(vectors)} vectors")
+            index = faiss_index.build_index(self.embeddings.dims, self.index_config, vectors)
+            trained_on = len(vectors)
+
+        index = faiss_index.id_mapped(index)
+        if len(vectors):
+            index.add_with_ids(vectors, ids)
+
+        index_name = f"base-{seq}"
+        index_path = os.path.join(self.store_path, index_name + ".faiss")
+        faiss_index.write_index(index, index_path + ".tmp")
+        os.replace(index_path + ".tmp", index_path)
+        del index
+        if kind == faiss_index.IVF_PQ:
+            self._write_exact_vectors(index_name, vectors, ids)
+
+        self._write_file(os.path.join(self.store_path, self.checkpoint_file), json.dumps({
+            "layout": self.layout, "index_name": index_name, "index_type": kind, "seq": seq,
+            "next_vector_id": next_vector_id, "trained_on": trained_on
+        }).encode("utf-8"))
+
+        new_base = faiss_index.read_index(index_path, kind, self.mmap)
+        faiss_index.configure_search(new_base, self.index_config)
+
+        with self._lock:
+            self.base_index = new_base
+            self._base_name = index_name
+            self._base_next_vector_id = next_vector_id
+            self._tombstones -= tombstones
+            self._tombstone_selector = None
+            if len(delta_ids):
+                # deleted from the delta while the new base was written, they are in the base now
+                _, current_ids = faiss_index.all_vectors(self.delta_index)
+                self._tombstones.update(int(vector_id) for vector_id in np.setdiff1d(delta_ids, current_ids))
+                self.delta_index.remove_ids(faiss.IDSelectorBatch(delta_ids))
+
+        self.delta_log.truncate(seq)
+        self._remove_stale_files(index_name)
+
+    def close(self):
+        """Closes the files of the store and releases its lock, the store is not usable afterwards."""
+        if self._compaction is not None:
+            self._compaction.join()
+
+        with self._lock:
+            self.delta_log.close()
+            self.id_map.close()
+            if self.lexical_index is not None:
+                self.lexical_index.close()
+            if isinstance(self.docstore, SqliteDocstore):
+                self.docstore.close()
+            # unmaps the base index
+            self.base_index = None
+            self._tombstone_selector = None
+        unlock_store(os.path.join(self.store_path, self.lock_file))
+
+    def _maybe_compact(self):
+        # only a promotion compacts by itself, a smaller store is demoted when it is compacted anyway
+        target = faiss_index.target_type(self.index_config, self.size(), self._base_type())
+        promote = target != faiss_index.FLAT and target != self._base_type()
+        if self.delta_log.pending < self.compact_threshold and not promote and not self._too_many_tombstones():
+            return
+
+        if not self.background_compaction:
+            self.persist()
+            return
+
+        with self._lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                return
+
+            self._compaction = threading.Thread(target=self.persist, name="faiss-compaction", daemon=True)
+            self._compaction.start()
+
+    def _too_many_tombstones(self) -> bool:
+        with self._lock:
+            if self.base_index is None or not self._tombstones:
+                return False
+            return len(self._tombstones) >= self.tombstone_ratio * self.base_index.ntotal
+
+    def ids(self) -> List[str]:
+        return self.id_map.all_doc_ids()
+
+    def export(self):
+        """Ids, documents and vectors of everything in the store."""
+        import numpy as np
+
+        with self._lock:
+            parts = [faiss_index.all_vectors(self.delta_index)]
+            if self.base_index is not None:
+                parts.append(self._base_vectors(self.base_index, self._base_name))
+            tombstones = np.fromiter(self._tombstones, dtype=np.int64, count=len(self._tombstones))
+
+        vectors = np.concatenate([part[0] for part in parts])
+        vector_ids = np.concatenate([part[1] for part in parts])
+        keep = ~np.isin(vector_ids, tombstones)
+        vectors, vector_ids = vectors[keep], vector_ids[keep]
+
+        doc_ids = self.id_map.doc_ids(vector_ids)
+        documents = self.docstore.mget(doc_ids.values())
+        rows = [i for i, vector_id in enumerate(vector_ids) if doc_ids.get(int(vector_id)) in documents]
+
+        ids = [doc_ids[int(vector_ids[i])] for i in rows]
+        return ids, [documents[id_] for id_ in ids], vectors[rows]
+
+    def size(self) -> int:
+        with self._lock:
+            base = self.base_index.ntotal if self.base_index is not None else 0
+            return base - len(self._tombstones) + self.delta_index.ntotal
+
+    def _base_type(self):
+        return faiss_index.index_type(self.base_index) if self.base_index is not None else faiss_index.FLAT
+
+    def _open_base(self, checkpoint):
+        self._next_vector_id = checkpoint.get('next_vector_id', 0)
+        self._base_next_vector_id = self._next_vector_id
+        if checkpoint.get('index_name'):
+            index_path = os.path.join(self.store_path, checkpoint['index_name'] + ".faiss")
+            self.base_index = faiss_index.read_index(index_path, checkpoint['index_type'], self.mmap)
+            self._base_name = checkpoint['index_name']
+            faiss_index.configure_search(self.base_index, self.index_config)
+
+    def _base_vectors(self, base, base_name):
+        """Vectors of the base with their ids. Those of a product quantized base are read from the exact copy written
+        next to it, its reconstructions are approximations that a rebuild would quantize again."""
+        import numpy as np
+
+        if faiss_index.index_type(base) != faiss_index.IVF_PQ:
+            return faiss_index.all_vectors(base)
+
+        vectors_path = os.path.join(self.store_path, base_name + ".vectors.npy")
+        if not os.path.exists(vectors_path):
+            print(f"{self.store_path} has no exact vectors for {base_name}, rebuilding from its approximations")
+            return faiss_index.all_vectors(base)
+        return (np.load(vectors_path, mmap_mode="r"),
+                np.load(os.path.join(self.store_path, base_name + ".ids.npy")))
+
+    def _write_exact_vectors(self, index_name, vectors, ids):
+        import numpy as np
+
+        for suffix, array in ((".vectors.npy", vectors), (".ids.npy", ids)):
+            path = os.path.join(self.store_path, index_name + suffix)
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+
+    def _replay(self, base_seq: int):
+        for record in self.delta_log.replay(after_seq=base_seq):
+            if record['op'] == "add":
+                self.delta_index.add_with_ids(record['vectors'], record['vector_ids'])
+                self._next_vector_id = max(self._next_vector_id, int(record['vector_ids'].max()) + 1)
+            elif record['op'] == "delete":
+                self._remove_vectors(record['vector_ids'])
+
+        if self.delta_log.pending:
+            print(f"Replayed {self.delta_log.pending} changes from {self.delta_log.path}")
+
+    def _migrate(self, checkpoint):
+        """Moves a store saved with langchain's FAISS.save_local, plus its delta log, to the segmented layout."""
+        from langchain_community.vectorstores.faiss import FAISS
+        import numpy as np
+
+        print(f"Migrating {self.store_path} to the memory mapped layout")
+        legacy = FAISS.load_local(self.store_path, self.embeddings, index_name=checkpoint['index_name'],
+                                  allow_dangerous_deserialization=True)
+        vectors, _ = faiss_index.all_vectors(legacy.index)
+        entries = {doc_id: (legacy.docstore.search(doc_id), vectors[position])
+                   for position, doc_id in legacy.index_to_docstore_id.items()}
+
+        legacy_log = os.path.join(self.store_path, "delta.log")
+        for record in DeltaLog(legacy_log).replay(checkpoint['seq']):
+            if record['op'] == "add":
+                entries.update({id_: (doc, vector) for id_, doc, vector in
+                                zip(record['ids'], record['documents'], record['vectors'])})
+            elif record['op'] == "delete":
+                for id_ in record['ids']:
+                    entries.pop(id_, None)
+
+        ids = list(entries.keys())
+        if ids:
+            vector_ids = np.arange(len(ids), dtype=np.int64)
+            self.docstore.add({id_: entries[id_][0] for id_ in ids})
+            self.id_map.add(vector_ids, ids, [entries[id_][0].metadata.get('file_name', '') for id_ in ids])
+            self.delta_index.add_with_ids(np.vstack([entries[id_][1] for id_ in ids]), vector_ids)
+            self._next_vector_id = len(ids)
+
+        self.persist()
+
+        for file_name in os.listdir(self.store_path):
+            if file_name.startswith("index") or file_name == "delta.log":
+                os.remove(os.path.join(self.store_path, file_name))
+
+    def _label_file_names(self):
+        """Stores written before the id map kept file names get them from their documents once."""
+        doc_ids = self.id_map.without_file_name()
+        if not doc_ids:
+            return
 
-        self.vector_store.save_local(self.store_path)
+        documents = self.docstore.mget(doc_ids)
+        self.id_map.set_file_names({doc_id: doc.metadata.get('file_name', '') for doc_id, doc in documents.items()})
 
-    def get_user_file_retriever_without_scores(self, k=10):
-        return self.vector_store.as_retriever(
-            # search_type="similarity_score_threshold",
-            # search_type="mmr",
+    def _sync_lexical_index(self):
+        """Indexes the chunks added while hybrid search was disabled, or before it existed."""
+        if self.lexical_index is None:
+            return
+
+        missing = self.lexical_index.sync()
+        if not missing:
+            return
+
+        print(f"Adding {len(missing)} chunks to the lexical index of {self.store_path}")
+        documents = self.docstore.mget([doc_id for _, doc_id in missing])
+        found = [(vector_id, documents[doc_id].page_content) for vector_id, doc_id in missing if doc_id in documents]
+        self.lexical_index.add([vector_id for vector_id, _ in found], [text for _, text in found])
+
+    def _read_checkpoint(self):
+        path = os.path.join(self.store_path, self.checkpoint_file)
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+
+        # stores written by save_local before the delta log existed
+        if os.path.exists(os.path.join(self.store_path, "index.faiss")):
+            return {"index_name": "index", "seq": 0}
+
+        return None
+
+    def _remove_stale_files(self, index_name):
+        for file_name in os.listdir(self.store_path):
+            if file_name.startswith("base-") and not file_name.startswith(index_name + "."):
+                try:
+                    os.remove(os.path.join(self.store_path, file_name))
+                except OSError:
+                    # still mapped by a search on windows, the next compaction removes it
+                    pass
+
+    @staticmethod
+    def _write_file(path, content: bytes):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def get_user_file_retriever_without_scores(self, k=10, lambda_mult=None, dedup_threshold=None):
+        return FaissDocumentsRetriever(
+            vector_store=self,
             search_kwargs={"k": k, "fetch_k": k * 5,
                            # score_threshold': 0.8,
-                           # 'lambda_mult': 0.25 mmr diversity parameter
+                           'lambda_mult': lambda_mult,
+                           'dedup_threshold': dedup_threshold,
                            # "filter": {"file": str(file_name)}
                            }
         )
 
-    def get_user_file_retriever(self, k=10):
-        return FaissDocumentsWithScoreRetriever(
-            vector_store=self.vector_store,
-            search_kwargs={"k": k, "fetch_k": k * 5,
-                           'score_threshold': 0.30,
-                           # 'lambda_mult': 0.25 mmr diversity parameter
-                           }
-        )
+    def get_user_file_retriever(self, k=10, file_names=None, **search_kwargs):
+        """`search_kwargs` override the `retrieval` settings, e.g. `lambda_mult` and `dedup_threshold`."""
+        return _user_file_retriever(self, k, file_names, search_kwargs)
+
+
+class KShardedFaissVectorStore:
+    """Faiss store split into shards by file name, each shard a KFaissVectorStore of its own.
+
+    Adding or removing a file touches one shard only, and compaction, retraining and persistence work on a shard at a
+    time. Searches run on every shard in parallel, faiss and sqlite release the GIL, and the rankings are merged.
+
+    Files are placed by a hash modulo the shard count, which is kept next to the shards. A store opened with another
+    count is resharded: its shards are moved aside and their contents moved into the new shards. With sharding
+    disabled again the shards are moved back into the unsharded store, see `unshard`.
+    """
+    shards_file = ".faiss_{name}_shards.json"
+
+    def __init__(self, embeddings: KEmbeddings, name: str, config=None, docstore=None):
+        config = config or {}
+        sharding = config.get('sharding', {})
+        count = sharding.get('shards', 8)
+
+        self.embeddings = embeddings
+        self.retrieval = config.get('retrieval', {})
+        self.hybrid = config.get('hybrid', {})
+        self.result_cache = LruCache(config.get('result_cache', {}).get('max_entries', 256))
+
+        stored = self._stored_shard_count(name)
+        if stored is not None and stored != count:
+            self._move_shards_aside(name, stored)
+        os.makedirs(KFaissVectorStore.store_root, exist_ok=True)
+        KFaissVectorStore._write_file(os.path.join(KFaissVectorStore.store_root, self.shards_file.format(name=name)),
+                                      json.dumps({"shards": count}).encode("utf-8"))
+
+        self.shards = [KFaissVectorStore(embeddings, f"{name}_shard{i}", config, docstore) for i in range(count)]
+        self._executor = ThreadPoolExecutor(max_workers=sharding.get('max_workers', 4),
+                                            thread_name_prefix="faiss-shard")
+
+        # the store used before sharding was enabled
+        _move_store(self, name, config, docstore)
+        # moved aside by resharding, also those left by an interrupted start
+        aside = KFaissVectorStore.store_dir.format(name=f"{name}_reshard")
+        for dir_name in sorted(os.listdir(KFaissVectorStore.store_root)):
+            if dir_name.startswith(aside) and dir_name[len(aside):].isdigit():
+                _move_store(self, f"{name}_reshard{dir_name[len(aside):]}", config, docstore)
+
+    @property
+    def version(self) -> int:
+        return sum(shard.version for shard in self.shards)
+
+    @property
+    def hybrid_enabled(self) -> bool:
+        return all(shard.hybrid_enabled for shard in self.shards)
+
+    def shard_of(self, file_name: str) -> int:
+        return zlib.crc32(file_name.encode("utf-8")) % len(self.shards)
+
+    def add_documents(self, documents: List[Document], **kwargs: Any) -> List[str]:
+        if not documents:
+            return []
+
+        matrix = self.embeddings.embed_documents_matrix([doc.page_content for doc in documents])
+        return self.add_embedded(documents, matrix, kwargs.get('ids'))
+
+    def add_embedded(self, documents: List[Document], matrix, ids: List[str] = None,
+                     store_documents: bool = True) -> List[str]:
+        ids = ids or [str(uuid.uuid4()) for _ in documents]
+
+        rows = {}
+        for row, doc in enumerate(documents):
+            rows.setdefault(self.shard_of(doc.metadata.get('file_name', '')), []).append(row)
+
+        for shard, shard_rows in rows.items():
+            self.shards[shard].add_embedded([documents[row] for row in shard_rows], matrix[shard_rows],
+                                            [ids[row] for row in shard_rows], store_documents)
+        return ids
+
+    def delete(self, ids: List[str], ignore_missing: bool = False):
+        found = {shard: list(shard.id_map.vector_ids(ids)) for shard in self.shards}
+
+        missing = set(ids).difference(*found.values())
+        if missing and not ignore_missing:
+            raise ValueError(f"Some specified ids do not exist in the current store. Ids not found: {missing}")
+
+        for shard, shard_ids in found.items():
+            if shard_ids:
+                shard.delete(shard_ids)
+
+    def touch(self):
+        for shard in self.shards:
+            shard.touch()
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter=None, fetch_k: int = 20, embedding=None,
+                                     **kwargs):
+        def search():
+            vector = embedding if embedding is not None else self.embeddings.embed_query(query)
+            return self.similarity_search_with_score_by_vector(vector, k, filter=filter, fetch_k=fetch_k, **kwargs)
+
+        return _cached_search(self.result_cache, self.version, "dense", query,
+                              dict(kwargs, k=k, filter=filter, fetch_k=fetch_k), search)
+
+    def similarity_search_with_score_by_vector(self, embedding, k: int = 4, filter=None, fetch_k: int = 20,
+                                               score_threshold=None, lambda_mult=None, dedup_threshold=None,
+                                               routed_files=None, **kwargs):
+        import numpy as np
+
+        query = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        filter, file_names = _split_filter(filter)
+        file_names = _routed(file_names, routed_files)
+        diversify = lambda_mult is not None or dedup_threshold is not None
+        n = fetch_k if filter or diversify else k
+
+        def search(shard):
+            return [(doc, score, (shard, vector_id)) for doc, score, vector_id in
+                    shard._documents(shard._dense_hits(query, n, file_names), filter, n)]
+
+        docs = sorted(self._fan_out(search, self._shards_of(file_names)), key=lambda doc: doc[1], reverse=True)[:n]
+
+        if score_threshold is not None:
+            docs = [doc for doc in docs if doc[1] >= score_threshold]
+        if diversify:
+            docs = _diversify(query[0], docs, self._vectors(docs), k, lambda_mult, dedup_threshold)
+
+        return [(doc, score) for doc, score, _ in docs[:k]]
+
+    def hybrid_search_with_score(self, query: str, k: int = 4, filter=None, fetch_k: int = 20,
+                                 score_threshold=None, lambda_mult=None, dedup_threshold=None, embedding=None,
+                                 routed_files=None, **kwargs):
+        """Fuses the merged dense and bm25 rankings of all shards, see KFaissVectorStore.hybrid_search_with_score."""
+        if not self.hybrid_enabled:
+            raise ValueError("Hybrid search is not enabled for the shards of " + self.shards[0].store_path)
+
+        search_kwargs = dict(k=k, filter=filter, fetch_k=fetch_k, score_threshold=score_threshold,
+                             lambda_mult=lambda_mult, dedup_threshold=dedup_threshold, routed_files=routed_files)
+        return _cached_search(self.result_cache, self.version, "hybrid", query, search_kwargs,
+                              lambda: self._hybrid_search(query, embedding, **search_kwargs))
+
+    def _hybrid_search(self, query: str, embedding, k, filter, fetch_k, score_threshold, lambda_mult, dedup_threshold,
+                       routed_files):
+        import numpy as np
+
+        filter, file_names = _split_filter(filter)
+        dense_files = _routed(file_names, routed_files)
+        if embedding is None:
+            embedding = self.embeddings.embed_query(query)
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+
+        def search(shard):
+            dense = shard._dense_hits(embedding, fetch_k, dense_files)
+            if score_threshold is not None:
+                dense = [hit for hit in dense if hit[0] >= score_threshold]
+            lexical = shard.lexical_index.search(query, fetch_k, file_names)
+            return [(dense, lexical, shard)]
+
+        dense, lexical = [], []
+        for shard_dense, shard_lexical, shard in self._fan_out(search, self._shards_of(file_names)):
+            dense.extend((score, (shard, vector_id)) for score, vector_id in shard_dense)
+            lexical.extend((score, (shard, vector_id)) for score, vector_id in shard_lexical)
+
+        rankings = [sorted(hits, key=lambda hit: hit[0], reverse=True)[:fetch_k] for hits in (dense, lexical)]
+        hits = _fuse(rankings, self.hybrid.get('rrf_k', 60))
+
+        diversify = lambda_mult is not None or dedup_threshold is not None
+        docs = self._documents(hits, filter, len(hits) if diversify else k)
+        if diversify:
+            docs = _diversify(embedding[0], docs, self._vectors(docs), k, lambda_mult, dedup_threshold)
+
+        return [(doc, score) for doc, score, _ in docs[:k]]
+
+    def _documents(self, hits, filter, n):
+        by_shard = {}
+        for score, (shard, vector_id) in hits:
+            by_shard.setdefault(shard, []).append((score, vector_id))
+
+        found = {}
+        for shard, shard_hits in by_shard.items():
+            found.update({(shard, vector_id): (doc, score, (shard, vector_id))
+                          for doc, score, vector_id in shard._documents(shard_hits, filter, len(shard_hits))})
+
+        return [found[key] for _, key in hits if key in found][:n]
+
+    def get_vectors(self, ids: List[str]) -> dict:
+        return {id_: vector for shard in self.shards for id_, vector in shard.get_vectors(ids).items()}
+
+    def existing_ids(self, ids: List[str]) -> set:
+        return set().union(*(shard.existing_ids(ids) for shard in self.shards))
+
+    def _vectors(self, docs):
+        import numpy as np
+
+        vectors = np.empty((len(docs), self.embeddings.dims), dtype=np.float32)
+        by_shard = {}
+        for row, (_, _, (shard, vector_id)) in enumerate(docs):
+            by_shard.setdefault(shard, []).append((row, vector_id))
+
+        for shard, rows in by_shard.items():
+            shard_vectors = shard._vectors([vector_id for _, vector_id in rows])
+            if shard_vectors is None:
+                return None
+            vectors[[row for row, _ in rows]] = shard_vectors
+
+        return vectors
 
-    def delete(self, ids: List[str]):
-        self.vector_store.delete(ids)
+    def _shards_of(self, file_names):
+        if file_names is None:
+            return self.shards
+        return [self.shards[i] for i in sorted({self.shard_of(file_name) for file_name in file_names})]
+
+    def _fan_out(self, search, shards) -> list:
+        results = []
+        for shard_results in self._executor.map(search, shards):
+            results.extend(shard_results)
+        return results
+
+    def ids(self) -> List[str]:
+        return [id_ for shard in self.shards for id_ in shard.ids()]
+
+    def size(self) -> int:
+        return sum(shard.size() for shard in self.shards)
+
+    def persist(self):
+        for shard in self.shards:
+            shard.persist()
+
+    def get_user_file_retriever(self, k=10, file_names=None, **search_kwargs):
+        return _user_file_retriever(self, k, file_names, search_kwargs)
+
+    @staticmethod
+    def _store_path(name):
+        return os.path.join(KFaissVectorStore.store_root, KFaissVectorStore.store_dir.format(name=name))
+
+    def _stored_shard_count(self, name):
+        path = os.path.join(KFaissVectorStore.store_root, self.shards_file.format(name=name))
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)['shards']
+
+        # stores sharded before the count was kept have a directory for each shard
+        count = 0
+        while os.path.exists(self._store_path(f"{name}_shard{count}")):
+            count += 1
+        return count or None
+
+    def _move_shards_aside(self, name, stored):
+        """Renames the shards of a store split into `stored` shards, their contents are moved into the new shards."""
+        print(f"Resharding {name} from {stored} shards")
+        for i in range(stored):
+            shard_path = self._store_path(f"{name}_shard{i}")
+            if not os.path.exists(shard_path):
+                continue
+
+            # fails while another process has the shard open, unlocked first as windows cannot rename it open
+            lock_path = os.path.join(shard_path, KFaissVectorStore.lock_file)
+            lock_store(lock_path)
+            unlock_store(lock_path)
+            j = i
+            while os.path.exists(self._store_path(f"{name}_reshard{j}")):
+                j += stored
+            os.rename(shard_path, self._store_path(f"{name}_reshard{j}"))
+
+    @classmethod
+    def unshard(cls, store: KFaissVectorStore, name: str, config, docstore=None):
+        """Moves the shards left by a store with sharding disabled since into the unsharded `store`."""
+        for shard in (KFaissVectorStore.store_dir.format(name=f"{name}_shard"),
+                      KFaissVectorStore.store_dir.format(name=f"{name}_reshard")):
+            for dir_name in sorted(os.listdir(KFaissVectorStore.store_root)):
+                if dir_name.startswith(shard) and dir_name[len(shard):].isdigit():
+                    _move_store(store, dir_name[len(".faiss_"):], config, docstore)
+
+        shards_path = os.path.join(KFaissVectorStore.store_root, cls.shards_file.format(name=name))
+        if os.path.exists(shards_path):
+            os.remove(shards_path)
+
+
+def _move_store(target, name, config, docstore):
+    """Moves the contents of the store `name` into the store `target` and removes it, documents already in `target`
+    are skipped so that an interrupted move is resumed."""
+    import shutil
+
+    store_path = os.path.join(KFaissVectorStore.store_root, KFaissVectorStore.store_dir.format(name=name))
+    if not os.path.exists(store_path):
+        return
+
+    print(f"Moving {store_path} into {getattr(target, 'store_path', 'the shards')}")
+    store = KFaissVectorStore(target.embeddings, name, config, docstore)
+    ids, documents, vectors = store.export()
+    store.close()
+
+    existing = set(target.ids())
+    rows = [i for i, id_ in enumerate(ids) if id_ not in existing]
+    if rows:
+        target.add_embedded([documents[i] for i in rows], vectors[rows], [ids[i] for i in rows])
+        target.persist()
+
+    try:
+        shutil.rmtree(store_path)
+    except OSError as e:
+        # the target has its contents, a later start moves what is left again
+        print(f"Removing {store_path} failed: {e}")
+
+
+def _user_file_retriever(store, k, file_names, search_kwargs):
+    search_kwargs = {"k": k, "fetch_k": k * 5,
+                     'score_threshold': 0.30,
+                     'lambda_mult': store.retrieval.get('lambda_mult'),
+                     'dedup_threshold': store.retrieval.get('dedup_threshold'),
+                     } | search_kwargs
+    if file_names is not None:
+        search_kwargs['filter'] = {"file_name": file_names}
+
+    if store.hybrid_enabled:
+        return HybridRetriever(vector_store=store, search_kwargs=search_kwargs)
+    return FaissDocumentsWithScoreRetriever(vector_store=store, search_kwargs=search_kwargs)
+
+
+def _cached_search(cache: LruCache, version: int, kind: str, query: str, search_kwargs: dict, search):
+    # the version is read first, results of a search racing an add are stored under a version already gone
+    key = (kind, " ".join(query.split()), repr(sorted(search_kwargs.items())), version)
+
+    docs = cache.get(key)
+    if docs is None:
+        docs = search()
+        cache.put(key, docs)
+
+    return list(docs)
+
+
+def _fuse(rankings, rrf_k: int):
+    """Reciprocal rank fusion of (score, key) rankings, best first."""
+    fused = {}
+    for hits in rankings:
+        for rank, (_, key) in enumerate(hits, start=1):
+            fused[key] = fused.get(key, 0.0) + 1.0 / (rrf_k + rank)
+
+    return sorted(((score, key) for key, score in fused.items()), key=lambda hit: hit[0], reverse=True)
+
+
+def _diversify(query, docs, vectors, k, lambda_mult, dedup_threshold):
+    """Reorders and thins out `docs` using their stored `vectors`, the candidates are not embedded again."""
+    if len(docs) < 2 or vectors is None:
+        return docs
+
+    if dedup_threshold is not None:
+        keep = rerank.near_duplicates(vectors, dedup_threshold)
+        docs = [doc for doc, kept in zip(docs, keep) if kept]
+        vectors = vectors[keep]
+
+    if lambda_mult is not None:
+        docs = [docs[i] for i in rerank.mmr(query, vectors, k, lambda_mult)]
+
+    return docs
+
+
+def _split_filter(filter):
+    filter = dict(filter or {})
+    file_names = filter.pop('file_name', None)
+    if isinstance(file_names, str):
+        file_names = [file_names]
+    return filter, file_names
+
+
+def _routed(file_names, routed_files):
+    if routed_files is None:
+        return file_names
+    if file_names is None:
+        return list(routed_files)
+    routed = set(routed_files)
+    return [file_name for file_name in file_names if file_name in routed]
+
+
+def _metadata_matches(metadata: dict, filter: dict) -> bool:
+    for key, value in filter.items():
+        if isinstance(value, list):
+            if metadata.get(key) not in value:
+                return False
+        elif metadata.get(key) != value:
+            return False
+    return True
+
+
+def add_documents_to_faiss(vector_store, embeddings: KEmbeddings, documents: List[Document], ids=None) -> List[str]:
+    """Embeds documents as one normalized float32 matrix and adds it to the FAISS index without a list round trip."""
+    if not documents:
+        return []
+
+    matrix = embeddings.embed_documents_matrix([doc.page_content for doc in documents])
+    ids = ids or [str(uuid.uuid4()) for _ in documents]
+
+    return add_vectors_to_faiss(vector_store, documents, matrix, ids)
+
+
+def add_vectors_to_faiss(vector_store, documents: List[Document], matrix, ids: List[str]) -> List[str]:
+    starting_len = len(vector_store.index_to_docstore_id)
+    vector_store.index.add(matrix)
+    vector_store.docstore.add(dict(zip(ids, documents)))
+    vector_store.index_to_docstore_id.update({starting_len + j: id_ for j, id_ in enumerate(ids)})
+
+    return ids
 
 
 class FaissDocumentsWithScoreRetriever(BaseRetriever):
-    vector_store: VectorStore
+    vector_store: Any
     search_kwargs: dict
 
     def _get_relevant_documents(
@@ -113,22 +1134,50 @@ class FaissDocumentsWithScoreRetriever(BaseRetriever):
         ]
 
 
+class FaissDocumentsRetriever(FaissDocumentsWithScoreRetriever):
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return [doc for doc, _ in self.vector_store.similarity_search_with_score(query, **self.search_kwargs)]
+
+
+class HybridRetriever(BaseRetriever):
+    """Dense and bm25 retrieval fused by reciprocal rank, a drop-in for FaissDocumentsWithScoreRetriever."""
+    vector_store: Any
+    search_kwargs: dict
+
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return [
+            Document(page_content=doc.page_content, metadata=doc.metadata | {'rrf_score': score})
+            for doc, score in self.vector_store.hybrid_search_with_score(query, **self.search_kwargs)
+        ]
+
+
 class KFaissTemporaryVectorStore:
-    def __init__(self, embeddings: KEmbeddings):
+    def __init__(self, embeddings: KEmbeddings, index_config=None):
         from langchain_community.vectorstores.faiss import DistanceStrategy
         from langchain_community.vectorstores.faiss import FAISS
-        import faiss
 
         self.embeddings = embeddings
+        self.index_config = index_config or {}
 
         self.vector_store = FAISS(
-            embedding_function=self.embeddings, index=faiss.IndexFlatIP(self.embeddings.dims),
+            embedding_function=self.embeddings,
+            index=faiss_index.build_index(self.embeddings.dims, self.index_config),
             docstore=InMemoryDocstore(), index_to_docstore_id={},
             distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
         )
 
     def add_documents(self, documents: List[Document], **kwargs: Any):
-        self.vector_store.add_documents(documents, **kwargs)
+        add_documents_to_faiss(self.vector_store, self.embeddings, documents, kwargs.get('ids'))
+
+        if faiss_index.needs_promotion(self.vector_store.index, self.index_config):
+            vectors, _ = faiss_index.all_vectors(self.vector_store.index)
+            index = faiss_index.build_index(self.embeddings.dims, self.index_config, vectors)
+            index.add(vectors)
+            self.vector_store.index = index
 
     def as_retriever(self, k=10, score_threshold=0.3):
         return FaissDocumentsWithScoreRetriever(
@@ -0,0 +1,160 @@
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Iterable, List
+
+from lib.ingest.docstores import connect
+
+# Words matching most chunks, they add nothing to a bm25 ranking but make fts5 score every row.
+_stopwords = frozenset("""
+a about all also am an and any are as at be been but by can could did do does for from had has have how i if in
+into is it its me my no not of on or our so than that the their them then there these they this to too us was we
+were what when where which who why will with would you your
+""".split())
+
+_token = re.compile(r"\w+", re.UNICODE)
+
+# contentless tables can only be deleted from since sqlite 3.43, older ones keep a copy of the text
+_contentless = sqlite3.sqlite_version_info >= (3, 43, 0)
+# underscores are part of identifiers like error codes and function names
+_columns = "content, " + ("content = '', contentless_delete = 1, " if _contentless else "") + \
+           "tokenize = \"unicode61 tokenchars '_'\""
+
+
+def _terms(query: str) -> List[str]:
+    terms = []
+    for token in _token.findall(query.lower()):
+        if token not in _stopwords and token not in terms:
+            terms.append(token)
+    return terms
+
+
+class LexicalIndex:
+    """BM25 ranked full text index of chunk text, an SQLite FTS5 table keyed by faiss vector id.
+
+    It lives in the store's SQLite file next to the `vector_ids` table of `SqliteVectorIdMap`, which file scoped
+    searches and `sync` join against. The table is contentless, the text is in the docstore already.
+
+    Query terms found in more than `max_term_ratio` of the chunks are dropped. fts5 has to score every chunk
+    containing a term to rank by bm25, which takes seconds for common words at a million chunks, while their idf adds
+    next to nothing to the ranking.
+    """
+
+    _term_cache_size = 10000
+    _always_ranked = 5000
+
+    def __init__(self, path: str, max_term_ratio: float = 0.02):
+        self.max_term_ratio = max_term_ratio
+
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        if _contentless:
+            self._drop_content()
+        self._conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS lexical USING fts5({_columns})")
+        self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS lexical_terms USING fts5vocab(lexical, 'row')")
+        self._conn.commit()
+
+        # counting the chunks of a term walks its whole posting list, the counts are cached until the rows change
+        self._term_counts = OrderedDict()
+        self._rows = None
+
+    def add(self, vector_ids: Iterable[int], texts: List[str]):
+        vector_ids = [int(id_) for id_ in vector_ids]
+        with self._lock:
+            # a replaced row counts as a change too, only the new rows add to the count
+            existing = self._count(vector_ids) if self._rows is not None else 0
+            self._conn.executemany("INSERT OR REPLACE INTO lexical (rowid, content) VALUES (?, ?)",
+                                   zip(vector_ids, texts))
+            self._conn.commit()
+            self._term_counts.clear()
+            if self._rows is not None:
+                self._rows += len(vector_ids) - existing
+
+    def delete(self, vector_ids: Iterable[int]):
+        with self._lock:
+            cursor = self._conn.executemany("DELETE FROM lexical WHERE rowid = ?", [(int(id_),) for id_ in vector_ids])
+            self._conn.commit()
+            self._term_counts.clear()
+            if self._rows is not None:
+                self._rows -= cursor.rowcount
+
+    def _count(self, vector_ids: List[int]) -> int:
+        count = 0
+        for i in range(0, len(vector_ids), 500):
+            batch = vector_ids[i:i + 500]
+            count += self._conn.execute(f"SELECT COUNT(*) FROM lexical WHERE rowid IN ({','.join('?' * len(batch))})",
+                                        batch).fetchone()[0]
+        return count
+
+    def _drop_content(self):
+        """Moves an index written with a copy of the chunk text into a contentless table."""
+        row = self._conn.execute("SELECT sql FROM sqlite_master WHERE name = 'lexical'").fetchone()
+        if row is None or "contentless_delete" in row[0]:
+            return
+
+        print("Moving the bm25 index to a contentless table")
+        self._conn.execute("DROP TABLE IF EXISTS lexical_contentless")
+        self._conn.execute(f"CREATE VIRTUAL TABLE lexical_contentless USING fts5({_columns})")
+        self._conn.execute("INSERT INTO lexical_contentless (rowid, content) SELECT rowid, content FROM lexical")
+        self._conn.execute("DROP TABLE IF EXISTS lexical_terms")
+        self._conn.execute("DROP TABLE lexical")
+        self._conn.execute("ALTER TABLE lexical_contentless RENAME TO lexical")
+        self._conn.commit()
+        # the copy of the text is given back to the file system
+        self._conn.execute("VACUUM")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def search(self, query: str, n: int, file_names: List[str] = None) -> list:
+        """Best `n` (score, vector id) pairs, higher scores are better."""
+        terms = self._selective_terms(_terms(query))
+        if not terms:
+            return []
+
+        sql = "SELECT rowid, bm25(lexical) FROM lexical WHERE lexical MATCH ?"
+        params = [" OR ".join(f'"{term}"' for term in terms)]
+        if file_names is not None:
+            sql += (" AND rowid IN (SELECT vector_id FROM vector_ids WHERE file_name IN "
+                    f"({','.join('?' * len(file_names))}))")
+            params.extend(file_names)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(n)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        # fts5 bm25 is negated so that ascending order is best first
+        return [(-score, vector_id) for vector_id, score in rows]
+
+    def _selective_terms(self, terms: List[str]) -> List[str]:
+        with self._lock:
+            if self._rows is None:
+                self._rows = self._conn.execute("SELECT COUNT(*) FROM lexical").fetchone()[0]
+
+            missing = [term for term in terms if term not in self._term_counts]
+            counts = dict(self._conn.execute(
+                f"SELECT term, doc FROM lexical_terms WHERE term IN ({','.join('?' * len(missing))})", missing
+            ).fetchall()) if missing else {}
+
+            for term in missing:
+                self._term_counts[term] = counts.get(term, 0)
+            for term in terms:
+                self._term_counts.move_to_end(term)
+            while len(self._term_counts) > self._term_cache_size:
+                self._term_counts.popitem(last=False)
+
+            # ranking a few thousand chunks is cheap, small stores keep all their terms
+            limit = max(self._always_ranked, self.max_term_ratio * self._rows)
+            return [term for term in terms if 0 < self._term_counts[term] <= limit]
+
+    def sync(self) -> List[tuple]:
+        """Drops rows of vectors the id map no longer has and returns the (vector id, doc id) pairs not indexed yet."""
+        with self._lock:
+            self._conn.execute("DELETE FROM lexical WHERE rowid NOT IN (SELECT vector_id FROM vector_ids)")
+            self._conn.commit()
+            self._term_counts.clear()
+            self._rows = None
+            return self._conn.execute("SELECT vector_id, doc_id FROM vector_ids v "
+                                      "WHERE NOT EXISTS (SELECT 1 FROM lexical WHERE rowid = v.vector_id)").fetchall()
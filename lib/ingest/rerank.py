@@ -0,0 +1,39 @@
+def near_duplicates(vectors, threshold: float):
+    """Mask of the rows to keep, a row is dropped when its cosine similarity to an earlier kept row reaches
+    `threshold`. Rows must be normalized and ordered best first."""
+    import numpy as np
+
+    similarities = vectors @ vectors.T
+    keep = np.ones(len(vectors), dtype=bool)
+    for i in range(1, len(vectors)):
+        if np.any(similarities[i, :i][keep[:i]] >= threshold):
+            keep[i] = False
+    return keep
+
+
+def mmr(query, vectors, k: int, lambda_mult: float) -> list:
+    """Indexes of `k` rows picked by maximal marginal relevance, in pick order. `lambda_mult` 1 is pure relevance,
+    0 pure diversity."""
+    import numpy as np
+
+    if len(vectors) == 0:
+        return []
+
+    relevance = vectors @ query
+    similarities = vectors @ vectors.T
+
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarities[selected[0]].copy()
+    available = np.ones(len(vectors), dtype=bool)
+    available[selected[0]] = False
+
+    while len(selected) < min(k, len(vectors)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, similarities[best], out=redundancy)
+
+    return selected
@@ -0,0 +1,40 @@
+import os
+import threading
+
+_held = {}
+_held_lock = threading.Lock()
+
+
+class StoreLockedError(Exception):
+    pass
+
+
+def lock_store(path: str):
+    """Takes an exclusive lock on the lock file `path` for this process, so that the app and the ingest CLI do not
+    write the same store with their own vector ids. Raises StoreLockedError when another process holds it."""
+    path = os.path.abspath(path)
+    with _held_lock:
+        if path in _held:
+            return
+
+        f = open(path, "a+")
+        try:
+            if os.name == "nt":
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            raise StoreLockedError(f"{os.path.dirname(path)} is in use by another process")
+        _held[path] = f
+
+
+def unlock_store(path: str):
+    with _held_lock:
+        f = _held.pop(os.path.abspath(path), None)
+        if f is not None:
+            # closing the file releases the lock
+            f.close()
@@ -1,5 +1,8 @@
+import codecs
+import re
+from html.parser import HTMLParser
 from io import BytesIO
-from typing import List
+from typing import BinaryIO, Iterable, Iterator, List
 
 import pdfplumber
 from langchain_core.documents import Document
@@ -16,97 +19,275 @@ class UserFileIndexBuilder:
         self._chunk_overlap = 0
 
     def create_index_user_file(self, file: BytesIO) -> (List[str], List[Document]):
-        if file.name.lower().endswith("md"):
-            return self.create_index_user_file_md(file)
-        elif file.name.lower().endswith("txt"):
-            return self.create_index_user_file_txt(file)
-        elif file.name.lower().endswith("pdf"):
-            return self.create_index_user_file_pdf(file)
-        elif file.name.lower().endswith("html") or file.name.lower().endswith("htm"):
-            return self.create_index_user_file_html(file)
-        else:
-            raise Exception("Unsupported file type:" + str(file.name))
+        docs = split_user_file(file.name, file.getvalue())
+        return self.vector_store.add_documents(docs), docs
 
     def create_index_user_file_pdf(self, file: BytesIO) -> (List[str], List[Document]):
-        file_name = file.name
-        pdf = pdfplumber.open(file)
+        docs = split_pdf(file.name, file.getvalue())
+        return self.vector_store.add_documents(docs), docs
 
-        ids, docs = [], []
-        for page in pdf.pages:
-            page_text = page.extract_text()
-            page_ids, page_docs = self._create_index_user_file_txt_segment(page_text, file_name)
+    def create_index_user_file_html(self, file: BytesIO) -> (List[str], List[Document]):
+        docs = split_html(file.name, file.getvalue())
+        return self.vector_store.add_documents(docs), docs
 
-            ids.extend(page_ids)
-            docs.extend(page_docs)
+    def create_index_user_file_txt(self, file: BytesIO) -> (List[str], List[Document]):
+        docs = split_txt(file.name, file.getvalue())
+        return self.vector_store.add_documents(docs), docs
 
-        return ids, docs
+    def create_index_user_file_md(self, file: BytesIO) -> (List[str], List[Document]):
+        docs = split_md(file.name, file.getvalue())
+        return self.vector_store.add_documents(docs), docs
 
-    def create_index_user_file_html(self, file: BytesIO) -> (List[str], List[Document]):
-        file_name = file.name
-        content = file.getvalue().decode("utf-8", errors="replace")
 
-        headers_to_split_on = [
-            ("h1", "Header 1"),
-            ("h2", "Header 2"),
-            ("h3", "Header 3"),
-            ("h4", "Header 4"),
-        ]
+# The splitters are module level functions of the file name and bytes so that they can run in a process pool.
 
-        html_splitter = HTMLHeaderTextSplitter(headers_to_split_on)
+# the splitters keep no state between calls, one of each serves every file
+_text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=400,
+    chunk_overlap=20,
+    length_function=len,
+    is_separator_regex=False,
+)
+_html_text_splitter = RecursiveCharacterTextSplitter(chunk_size=400, chunk_overlap=30)
+_md_headers = [
+    ("#", "H1"),
+    ("##", "H2"),
+    ("###", "H3"),
+    ("####", "H4"),
+]
+_md_header_line = re.compile(r"(#{1,4})\s")
 
-        html_header_splits = html_splitter.split_text(content)
+def split_user_file(file_name: str, data: bytes) -> List[Document]:
+    if file_name.lower().endswith("md"):
+        return split_md(file_name, data)
+    elif file_name.lower().endswith("txt"):
+        return split_txt(file_name, data)
+    elif is_pdf(file_name):
+        return split_pdf(file_name, data)
+    elif file_name.lower().endswith("html") or file_name.lower().endswith("htm"):
+        return split_html(file_name, data)
+    else:
+        raise Exception("Unsupported file type:" + str(file_name))
 
-        chunk_size = 400
-        chunk_overlap = 30
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size, chunk_overlap=chunk_overlap
-        )
 
-        docs = text_splitter.split_documents(html_header_splits)
-        docs = [Document(page_content=doc.page_content, metadata={"file_name": file_name}) for doc in docs]
+def split_pdf(file_name: str, data: bytes) -> List[Document]:
+    return [doc for text in extract_pdf_pages(data) for doc in split_text(text, file_name)]
 
-        return self.vector_store.add_documents(docs), docs
 
-    def create_index_user_file_txt(self, file: BytesIO) -> (List[str], List[Document]):
-        file_name = file.name
-        content = file.getvalue().decode("utf-8", errors="replace")
+def is_pdf(file_name: str) -> bool:
+    return file_name.lower().endswith("pdf")
 
-        return self._create_index_user_file_txt_segment(content, file_name)
 
-    def _create_index_user_file_txt_segment(self, text, file_name) -> (List[str], List[Document]):
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=400,
-            chunk_overlap=20,
-            length_function=len,
-            is_separator_regex=False,
-        )
-        docs = text_splitter.create_documents([text])
-        docs = [Document(page_content=doc.page_content, metadata={"file_name": file_name}) for doc in docs]
+def pdf_page_count(data: bytes) -> int:
+    with pdfplumber.open(BytesIO(data)) as pdf:
+        return len(pdf.pages)
 
-        return self.vector_store.add_documents(docs), docs
 
-    def create_index_user_file_md(self, file: BytesIO) -> (List[str], List[Document]):
-        headers_to_split_on = [
-            ("#", "H1"),
-            ("##", "H2"),
-            ("###", "H3"),
-            ("####", "H4"),
-        ]
+def pdf_page_ranges(pages: int, workers: int, min_pages: int = 8) -> List[tuple]:
+    """(start, stop) page ranges spreading `pages` over up to `workers` processes, at least `min_pages` each."""
+    parts = max(1, min(workers, pages // max(1, min_pages)))
+    bounds = [pages * i // parts for i in range(parts + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
 
-        content = file.getvalue().decode("utf-8", errors="replace")
 
-        markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=headers_to_split_on)
-        md_header_splits = markdown_splitter.split_text(content)
+def extract_pdf_pages(data: bytes, start: int = 0, stop: int = None) -> List[str]:
+    """Text of the pages from `start` to `stop`, pages without a text layer are empty."""
+    with pdfplumber.open(BytesIO(data)) as pdf:
+        return [page.extract_text() or "" for page in pdf.pages[start:stop]]
 
-        def to_title(metadata):
-            headers = [v for k, v in metadata.items() if k in ["H1", "H2", "H3", "H4"]]
-            return "# " + " - ".join(headers)
 
-        docs = [
-            Document(
-                page_content=to_title(split.metadata) + "\n" + split.page_content,
-                metadata={"file_name": file.name})
-            for split in md_header_splits
-        ]
+def split_html(file_name: str, data: bytes) -> List[Document]:
+    content = data.decode("utf-8", errors="replace")
 
-        return self.vector_store.add_documents(docs), docs
+    headers_to_split_on = [
+        ("h1", "Header 1"),
+        ("h2", "Header 2"),
+        ("h3", "Header 3"),
+        ("h4", "Header 4"),
+    ]
+
+    html_splitter = HTMLHeaderTextSplitter(headers_to_split_on)
+
+    html_header_splits = html_splitter.split_text(content)
+
+    docs = _html_text_splitter.split_documents(html_header_splits)
+    return [Document(page_content=doc.page_content, metadata={"file_name": file_name}) for doc in docs]
+
+
+def split_txt(file_name: str, data: bytes) -> List[Document]:
+    return split_text(data.decode("utf-8", errors="replace"), file_name)
+
+
+def split_text(text: str, file_name: str) -> List[Document]:
+    return [Document(page_content=chunk, metadata={"file_name": file_name}) for chunk in _text_splitter.split_text(text)]
+
+
+def split_md(file_name: str, data: bytes) -> List[Document]:
+    return split_md_text(data.decode("utf-8", errors="replace"), file_name)
+
+
+def split_md_text(content: str, file_name: str) -> List[Document]:
+    markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=_md_headers)
+    md_header_splits = markdown_splitter.split_text(content)
+
+    def to_title(metadata):
+        headers = [v for k, v in metadata.items() if k in ["H1", "H2", "H3", "H4"]]
+        return "# " + " - ".join(headers)
+
+    return [
+        Document(
+            page_content=to_title(split.metadata) + "\n" + split.page_content,
+            metadata={"file_name": file_name})
+        for split in md_header_splits
+    ]
+
+
+def is_streamable(file_name: str) -> bool:
+    return file_name.lower().endswith(("md", "txt", "html", "htm"))
+
+
+def stream_user_file(file_name: str, stream: BinaryIO, block_size: int = 2 ** 20) -> Iterator[Document]:
+    """Chunks of a txt, md or html file read from `stream` a block at a time, so that only about a block of the file
+    is held however large it is.
+
+    Chunks end where split_user_file ends them but at block boundaries, where text split apart is split again with
+    the next block. Html is reduced to its text, without the header splitting of split_html.
+    """
+    blocks = _decoded_blocks(stream, block_size)
+    if file_name.lower().endswith("md"):
+        yield from _stream_md(file_name, blocks, block_size)
+    elif file_name.lower().endswith("txt"):
+        yield from _stream_text(file_name, blocks, block_size, _text_splitter)
+    elif file_name.lower().endswith("html") or file_name.lower().endswith("htm"):
+        yield from _stream_text(file_name, _html_text(blocks), block_size, _html_text_splitter)
+    else:
+        raise Exception("Unsupported file type:" + str(file_name))
+
+
+def _decoded_blocks(stream: BinaryIO, block_size: int) -> Iterator[str]:
+    # characters split across blocks are decoded with the next block
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                yield tail
+            return
+        yield decoder.decode(block)
+
+
+def _stream_text(file_name: str, blocks: Iterable[str], block_size: int,
+                 splitter: RecursiveCharacterTextSplitter) -> Iterator[Document]:
+    buffer = ""
+    for block in blocks:
+        buffer += block
+        if len(buffer) < block_size:
+            continue
+
+        chunks = splitter.split_text(buffer)
+        if not chunks:
+            buffer = ""
+            continue
+
+        # the last chunk may go on in the next block, it is split again with it
+        for chunk in chunks[:-1]:
+            yield Document(page_content=chunk, metadata={"file_name": file_name})
+        buffer = buffer[buffer.rfind(chunks[-1]):]
+
+    for chunk in splitter.split_text(buffer):
+        yield Document(page_content=chunk, metadata={"file_name": file_name})
+
+
+def _stream_md(file_name: str, blocks: Iterable[str], block_size: int) -> Iterator[Document]:
+    # sections are split together up to a block, a section is only cut when it is larger than a block on its own.
+    # The headers a cut section is under are repeated before its rest, its chunks keep their titles.
+    headers = {}
+    section, size = [], 0
+    fenced = False
+    for line in _lines(blocks, block_size):
+        level = None
+        if line.lstrip().startswith(("```", "~~~")):
+            fenced = not fenced
+        elif not fenced:
+            match = _md_header_line.match(line)
+            level = len(match.group(1)) if match else None
+
+        if size >= block_size and (level is not None or size >= 4 * block_size):
+            yield from split_md_text("".join(headers[i] for i in sorted(headers)) + "".join(section), file_name)
+            headers = _md_open_headers(headers, section)
+            section, size = [], 0
+
+        section.append(line)
+        size += len(line)
+
+    if section:
+        yield from split_md_text("".join(headers[i] for i in sorted(headers)) + "".join(section), file_name)
+
+
+def _md_open_headers(headers: dict, lines: List[str]) -> dict:
+    """The header lines, by level, that the text after `lines` is under."""
+    headers = dict(headers)
+    fenced = False
+    for line in lines:
+        if line.lstrip().startswith(("```", "~~~")):
+            fenced = not fenced
+            continue
+        match = None if fenced else _md_header_line.match(line)
+        if match:
+            level = len(match.group(1))
+            headers = {i: header for i, header in headers.items() if i < level}
+            headers[level] = line if line.endswith("\n") else line + "\n"
+    return headers
+
+
+def _lines(blocks: Iterable[str], block_size: int) -> Iterator[str]:
+    rest = ""
+    for block in blocks:
+        lines = (rest + block).splitlines(keepends=True)
+        rest = lines.pop() if lines and not lines[-1].endswith(("\n", "\r")) else ""
+        yield from lines
+        # a line longer than a block is not held whole
+        if len(rest) >= block_size:
+            yield rest
+            rest = ""
+    if rest:
+        yield rest
+
+
+class _HtmlText(HTMLParser):
+    _skipped = {"script", "style", "head", "noscript", "template"}
+    _blocks = {"p", "div", "br", "li", "tr", "pre", "table", "ul", "ol", "section", "article", "blockquote",
+               "h1", "h2", "h3", "h4", "h5", "h6"}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._skipped:
+            self._skipping += 1
+        elif tag in self._blocks:
+            self.parts.append("\n\n")
+
+    def handle_endtag(self, tag):
+        if tag in self._skipped:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag in self._blocks:
+            self.parts.append("\n\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+
+
+def _html_text(blocks: Iterable[str]) -> Iterator[str]:
+    parser = _HtmlText()
+    for block in blocks:
+        parser.feed(block)
+        yield "".join(parser.parts)
+        parser.parts.clear()
+
+    parser.close()
+    yield "".join(parser.parts)
@@ -1,8 +1,13 @@
+import hashlib
+import json
+
 from langchain_core.messages import AIMessage
+from langchain_core.prompt_values import PromptValue
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnableLambda
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 
 from lib.utils.chain_output_sink import ChainOutputSink
+from lib.utils.sqlite_cache import SqliteLruCache
 
 
 class Kllm:
@@ -11,6 +16,16 @@ class Kllm:
         self.code_llm = LLMFactory.build(config['code'])
         self.deterministic_llm = LLMFactory.build(config['deterministic'])
 
+        # the same prompt always gets the same answer from the deterministic llm, answers are kept by prompt hash
+        self.deterministic_cache = None
+        cache_config = config['deterministic'].get('cache')
+        if cache_config:
+            self.deterministic_cache = SqliteLruCache.shared(cache_config['path'], cache_config['max_entries'],
+                                                             table="llm", ttl_seconds=cache_config.get('ttl_seconds'))
+            self.deterministic_namespace = json.dumps(
+                {key: value for key, value in config['deterministic'].items() if key not in ("base_url", "cache")},
+                sort_keys=True)
+
     def get_answer_llm(self):
         return self.answer_llm
 
@@ -25,10 +40,27 @@ class Kllm:
                 | self.code_llm)
 
     def get_deterministic_llm_runnable(self, name, chain_sink: ChainOutputSink):
+        llm = self.deterministic_llm
+        if self.deterministic_cache is not None:
+            llm = RunnableLambda(lambda x, config: self.invoke_cached(x, config, name, chain_sink), name=name)
+
         return (RunnableLambda(lambda x: self.push_prompt(x, name, chain_sink))
-                | self.deterministic_llm
+                | llm
                 | RunnableLambda(lambda x: self.push_output(x, name, chain_sink)))
 
+    def invoke_cached(self, prompt: PromptValue, config: RunnableConfig, name, chain_sink: ChainOutputSink):
+        messages = [{"role": msg.type, "content": msg.content} for msg in prompt.to_messages()]
+        key = hashlib.sha256(f"{self.deterministic_namespace}\0{json.dumps(messages)}".encode("utf-8")).hexdigest()
+
+        cached = self.deterministic_cache.get(key)
+        if cached is not None:
+            chain_sink.add_debug(name="llm_cache_" + name, content={"hit": key, **self.deterministic_cache.stats()})
+            return AIMessage(content=cached.decode("utf-8"))
+
+        output = self.deterministic_llm.invoke(prompt, config)
+        self.deterministic_cache.put(key, output.content.encode("utf-8"))
+        return output
+
     def get_answer_llm_runnable(self, name, chain_sink: ChainOutputSink):
         return (RunnableLambda(lambda x: self.push_prompt(x, name, chain_sink))
                 | self.answer_llm)
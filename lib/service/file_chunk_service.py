@@ -1,25 +1,66 @@
+import hashlib
 import uuid
-from typing import List, Optional
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import bindparam, delete, func, insert, update
+from sqlalchemy.orm import Session, undefer
 
 from lib.db.db_manager import DatabaseManager
 from lib.db.model.file_chunk import FileChunk
 
 
+_batch_size = 500
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def insert_chunks(session: Session, chunks: List[FileChunk]):
+    """Inserts `chunks` with one executemany, chunks without an idx are numbered after the last chunk of their file."""
+    next_idx = {}
+    rows = []
+    for chunk in chunks:
+        idx = chunk.idx
+        if idx is None:
+            if chunk.name not in next_idx:
+                last = session.query(func.max(FileChunk.idx)).filter(FileChunk.name == chunk.name).scalar()
+                next_idx[chunk.name] = 0 if last is None else last + 1
+            idx = next_idx[chunk.name]
+            next_idx[chunk.name] += 1
+
+        # content is nullable, a chunk without it has no hash to be found by
+        hash_ = chunk.content_hash
+        if hash_ is None and chunk.content is not None:
+            hash_ = content_hash(chunk.content)
+        rows.append({"id": chunk.id or uuid.uuid4(), "name": chunk.name, "idx": idx, "chunk_id": chunk.chunk_id,
+                     "content": chunk.content, "content_hash": hash_})
+
+    if rows:
+        # a core insert of the table, the orm bulk insert costs more than the executemany itself
+        session.execute(insert(FileChunk.__table__), rows)
+
+
+def renumber_chunks(session: Session, idxs: Dict[str, int]):
+    """Sets the idx of the chunks in `idxs`, by chunk id, e.g. to their position in a file stored again."""
+    if idxs:
+        table = FileChunk.__table__
+        session.execute(update(table).where(table.c.chunk_id == bindparam("b_chunk_id")).values(idx=bindparam("b_idx")),
+                        [{"b_chunk_id": chunk_id, "b_idx": idx} for chunk_id, idx in idxs.items()])
+
+
+def delete_chunks(session: Session, chunk_ids: List[str]):
+    for i in range(0, len(chunk_ids), _batch_size):
+        session.execute(delete(FileChunk).where(FileChunk.chunk_id.in_(chunk_ids[i:i + _batch_size])))
+
+
 class FileChunkService:
     def __init__(self, db_manager: DatabaseManager):
         self.db_manager = db_manager
 
     def add_all(self, chunks: List[FileChunk]):
         with self.db_manager.session_scope() as session:
-            new_files = [FileChunk(
-                id=uuid.uuid4(),
-                name=chunk.name,
-                idx=chunk.idx,
-                chunk_id=chunk.chunk_id,
-                content=chunk.content
-            ) for chunk in chunks]
-
-            session.add_all(new_files)
+            insert_chunks(session, chunks)
 
     def find_file_chunks(self, file_name: str) -> List[FileChunk]:
         with self.db_manager.session_scope() as session:
@@ -32,6 +73,49 @@ class FileChunkService:
 
             return chunks
 
+    def find_by_chunk_ids(self, chunk_ids: List[str]) -> List[FileChunk]:
+        with self.db_manager.session_scope() as session:
+            query = session.query(FileChunk).options(undefer(FileChunk.content))
+            chunks = query.filter(FileChunk.chunk_id.in_(chunk_ids)).all()
+
+            for chunk in chunks:
+                session.expunge(chunk)
+
+            return chunks
+
+    def find_existing_chunk_ids(self, chunk_ids: List[str]) -> Set[str]:
+        existing = set()
+        with self.db_manager.session_scope() as session:
+            for i in range(0, len(chunk_ids), _batch_size):
+                existing.update(chunk_id for chunk_id, in session.query(FileChunk.chunk_id)
+                                .filter(FileChunk.chunk_id.in_(chunk_ids[i:i + _batch_size])))
+        return existing
+
+    def find_chunk_ids_by_content_hashes(self, content_hashes: List[str]) -> Dict[str, str]:
+        """A chunk id for each of the hashes some stored chunk has, chunks shared by files have several."""
+        found = {}
+        with self.db_manager.session_scope() as session:
+            for i in range(0, len(content_hashes), _batch_size):
+                rows = (session.query(FileChunk.content_hash, FileChunk.chunk_id)
+                        .filter(FileChunk.content_hash.in_(content_hashes[i:i + _batch_size])))
+                found.update(rows)
+        return found
+
+    def backfill_content_hashes(self):
+        """Hashes the chunks stored before chunks had a content hash."""
+        with self.db_manager.session_scope() as session:
+            rows = (session.query(FileChunk.id, FileChunk.content)
+                    .filter(FileChunk.content_hash.is_(None), FileChunk.content.isnot(None)).all())
+            if rows:
+                print(f"Hashing {len(rows)} file chunks")
+                session.execute(update(FileChunk), [{"id": id_, "content_hash": content_hash(content)}
+                                                    for id_, content in rows])
+
+    def next_chunk_idx(self, file_name: str) -> int:
+        with self.db_manager.session_scope() as session:
+            idx = session.query(func.max(FileChunk.idx)).filter(FileChunk.name == file_name).scalar()
+            return 0 if idx is None else idx + 1
+
     def find_by_id(self, id: uuid) -> Optional[FileChunk]:
         with self.db_manager.session_scope() as session:
             chunk = session.query(FileChunk).get(id)
@@ -45,6 +129,10 @@ class FileChunkService:
             if chunk is not None:
                 session.delete(chunk)
 
+    def delete_by_chunk_ids(self, chunk_ids: List[str]):
+        with self.db_manager.session_scope() as session:
+            delete_chunks(session, chunk_ids)
+
     def delete_by_file_name(self, file_name: str):
         with self.db_manager.session_scope() as session:
             session.query(FileChunk).filter(FileChunk.name == file_name).delete()
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import shutil
+import uuid
+from datetime import datetime
+from typing import BinaryIO, List
+
+from sqlalchemy.orm import defer, undefer
+
+from lib.db.db_manager import DatabaseManager
+from lib.db.model.ingest_job import IngestJob
+
+
+# large uploads are written here and queued by path, the worker streams them instead of loading them from the database
+spool_dir = os.path.join("data", "uploads")
+
+
+def file_hash(path: str, block_size: int = 2 ** 20) -> str:
+    content_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+class IngestJobService:
+    def __init__(self, db_manager: DatabaseManager):
+        self.db_manager = db_manager
+
+    def enqueue(self, name: str, data: bytes = None, path: str = None) -> IngestJob:
+        """Queues a file by its content or, for a file too large to hold, by its path."""
+        with self.db_manager.session_scope() as session:
+            job = IngestJob(id=uuid.uuid4(), name=name, status=IngestJob.QUEUED, data=data, path=path,
+                            content_hash=hashlib.sha256(data).hexdigest() if data is not None else file_hash(path))
+            session.add(job)
+
+            queued = IngestJob(id=job.id, name=name, status=job.status, content_hash=job.content_hash)
+        return queued
+
+    def enqueue_spooled(self, name: str, stream: BinaryIO) -> IngestJob:
+        """Queues an upload by a copy of it in `spool_dir`, removed once its job is done."""
+        os.makedirs(spool_dir, exist_ok=True)
+        path = os.path.join(spool_dir, f"{uuid.uuid4()}{os.path.splitext(name)[1]}")
+        with open(path, "wb") as f:
+            shutil.copyfileobj(stream, f, 2 ** 20)
+        return self.enqueue(name, path=os.path.abspath(path))
+
+    def claim(self, limit: int) -> List[IngestJob]:
+        """Marks up to `limit` of the oldest queued jobs running and returns them with their checkpointed results."""
+        with self.db_manager.session_scope() as session:
+            # the data of a job queued by path is empty, the rest is read below
+            jobs = (session.query(IngestJob).options(undefer('*'), defer(IngestJob.data))
+                    .filter(IngestJob.status == IngestJob.QUEUED)
+                    .order_by(IngestJob.created).limit(limit).all())
+
+            # a job another worker claimed since the select is no longer queued and not updated
+            claimed = [job for job in jobs if session.query(IngestJob)
+                       .filter(IngestJob.id == job.id, IngestJob.status == IngestJob.QUEUED)
+                       .update({"status": IngestJob.RUNNING}, synchronize_session=False)]
+
+            data = dict(session.query(IngestJob.id, IngestJob.data)
+                        .filter(IngestJob.id.in_([job.id for job in claimed if job.path is None])))
+            for job in jobs:
+                session.expunge(job)
+            for job in claimed:
+                job.data = data.get(job.id)
+            return claimed
+
+    def requeue_running(self) -> int:
+        """Queues the jobs left running by a stopped app again, they resume from their last checkpoint."""
+        with self.db_manager.session_scope() as session:
+            return (session.query(IngestJob).filter(IngestJob.status == IngestJob.RUNNING)
+                    .update({"status": IngestJob.QUEUED}))
+
+    def requeue(self, job_ids: List[uuid.UUID]):
+        """Queues running jobs again, they resume from their last checkpoint."""
+        if job_ids:
+            with self.db_manager.session_scope() as session:
+                session.query(IngestJob).filter(IngestJob.id.in_(job_ids), IngestJob.status == IngestJob.RUNNING) \
+                    .update({"status": IngestJob.QUEUED, "updated": datetime.utcnow()})
+
+    def checkpoint(self, job_id: uuid, stage: str, **values):
+        with self.db_manager.session_scope() as session:
+            session.query(IngestJob).filter(IngestJob.id == job_id).update(
+                dict(values, stage=stage, updated=datetime.utcnow()))
+
+    def finish(self, job_id: uuid, stage: str):
+        with self.db_manager.session_scope() as session:
+            path = session.query(IngestJob.path).filter(IngestJob.id == job_id).scalar()
+
+        # the upload and the intermediate results are not needed anymore, the file and its chunks are saved
+        self.checkpoint(job_id, stage, status=IngestJob.DONE, data=None, content=None, chunks=None, vectors=None)
+        _remove_spooled(path)
+
+    def fail(self, job_id: uuid, error: str):
+        with self.db_manager.session_scope() as session:
+            session.query(IngestJob).filter(IngestJob.id == job_id, IngestJob.status == IngestJob.RUNNING).update(
+                {"status": IngestJob.FAILED, "error": error, "updated": datetime.utcnow()})
+
+    def find_by_ids(self, ids: List[uuid.UUID]) -> List[IngestJob]:
+        with self.db_manager.session_scope() as session:
+            jobs = session.query(IngestJob).filter(IngestJob.id.in_(ids)).order_by(IngestJob.created).all()
+
+            for job in jobs:
+                session.expunge(job)
+            return jobs
+
+    def find_unfinished(self) -> List[IngestJob]:
+        with self.db_manager.session_scope() as session:
+            jobs = (session.query(IngestJob)
+                    .filter(IngestJob.status.in_([IngestJob.QUEUED, IngestJob.RUNNING]))
+                    .order_by(IngestJob.created).all())
+
+            for job in jobs:
+                session.expunge(job)
+            return jobs
+
+    def delete_by_id(self, id: uuid):
+        with self.db_manager.session_scope() as session:
+            job = session.query(IngestJob).get(id)
+            if job is not None:
+                session.delete(job)
+                _remove_spooled(job.path)
+
+
+def _remove_spooled(path: str):
+    # files queued by the bulk ingest CLI are the user's own, only spooled uploads are removed
+    if path and os.path.dirname(path) == os.path.abspath(spool_dir) and os.path.exists(path):
+        os.remove(path)
@@ -1,10 +1,12 @@
 import uuid
-from typing import List, Optional
+from typing import Dict, List, Optional, Set
 
-from sqlalchemy import update
+from sqlalchemy import insert, update
 
 from lib.db.db_manager import DatabaseManager
+from lib.db.model.file_chunk import FileChunk
 from lib.db.model.user_files import UserFile
+from lib.service.file_chunk_service import delete_chunks, insert_chunks, renumber_chunks
 
 
 class UserFileService:
@@ -18,6 +20,31 @@ class UserFileService:
             file = UserFile(id=user_file.id, name=user_file.name, content=user_file.content, summary=user_file.summary)
         return file
 
+    def save_all(self, user_files: List[UserFile], chunks: List[FileChunk] = None,
+                 deleted_chunk_ids: List[str] = None, chunk_idxs: Dict[str, int] = None) -> List[UserFile]:
+        """Writes `user_files` with the chunks they gained and without the ones they lost in one transaction, with an
+        executemany per table. The chunks they kept are moved to their positions in `chunk_idxs`."""
+        with self.db_manager.session_scope() as session:
+            rows = [{"id": user_file.id, "name": user_file.name, "content": user_file.content,
+                     "summary": user_file.summary, "content_hash": user_file.content_hash} for user_file in user_files]
+
+            # a file saved again, updated or after an interrupted ingestion, replaces the earlier row
+            existing = {id_ for id_, in session.query(UserFile.id).filter(UserFile.id.in_(row["id"] for row in rows))}
+            updated = [row for row in rows if row["id"] in existing]
+            if updated:
+                session.execute(update(UserFile), updated)
+            if len(updated) < len(rows):
+                session.execute(insert(UserFile), [row for row in rows if row["id"] not in existing])
+
+            delete_chunks(session, deleted_chunk_ids or [])
+            renumber_chunks(session, chunk_idxs or {})
+            insert_chunks(session, chunks or [])
+
+            files = [UserFile(id=user_file.id, name=user_file.name, content=user_file.content,
+                              summary=user_file.summary, content_hash=user_file.content_hash)
+                     for user_file in user_files]
+        return files
+
     def update_summary(self, user_file_id: int, new_summary: str):
         with self.db_manager.session_scope() as session:
             stmt = (
@@ -27,6 +54,11 @@ class UserFileService:
             )
             session.execute(stmt)
 
+    def update_summaries(self, summaries: Dict[uuid.UUID, str]):
+        if summaries:
+            with self.db_manager.session_scope() as session:
+                session.execute(update(UserFile), [{"id": id_, "summary": summary} for id_, summary in summaries.items()])
+
     ## TO REMOVE
     def add(self, name: str, content: str):
         with self.db_manager.session_scope() as session:
@@ -63,6 +95,19 @@ class UserFileService:
 
             return files
 
+    def find_content_hashes(self) -> Set[str]:
+        with self.db_manager.session_scope() as session:
+            return {content_hash for content_hash, in session.query(UserFile.content_hash)
+                    .filter(UserFile.content_hash.isnot(None))}
+
+    def find_by_names(self, names: List[str]) -> List[UserFile]:
+        with self.db_manager.session_scope() as session:
+            files = session.query(UserFile).filter(UserFile.name.in_(names)).all()
+
+            for file in files:
+                session.expunge(file)
+            return files
+
     def find_by_id(self, id: uuid) -> Optional[UserFile]:
         with self.db_manager.session_scope() as session:
             user_file = session.query(UserFile).get(id)
@@ -1,9 +1,21 @@
+import threading
+from typing import Optional
+
 import streamlit as st
 
 from lib.chain.prompt_registry import PromptRegistry
+from lib.chain.summary_chain import FileSummarizer, file_summarizer as build_file_summarizer
 from lib.db.db_manager import DatabaseManager
+from lib.ingest.docstores import FileChunkDocstore
+from lib.ingest.file_router import FileRouter
+from lib.ingest.ingest_worker import IngestWorker
+from lib.ingest.ingestion_pipeline import IngestionPipeline
 from lib.ingest.kembeddings import KEmbeddings
 from lib.ingest.kvectorstore import KVectorStore
+from lib.llm.kllm import Kllm
+from lib.service.file_chunk_service import FileChunkService
+from lib.service.ingest_job_service import IngestJobService
+from lib.service.user_file_service import UserFileService
 from lib.utils.yaml_utils import load_yaml_file
 
 
@@ -24,7 +36,56 @@ def user_file_embeddings() -> KEmbeddings:
 @st.cache_resource
 def user_file_vector_store() -> KVectorStore:
     print("Creating user file vector store")
-    return KVectorStore(user_file_embeddings(), "user_files", config()['vector_store'])
+    chunk_service = FileChunkService(db_manager())
+    # chunks stored before content hashes get theirs, so that their vectors are reused
+    chunk_service.backfill_content_hashes()
+    docstore = FileChunkDocstore(chunk_service, config()['vector_store'].get('hot_documents', 1024))
+    return KVectorStore(user_file_embeddings(), "user_files", config()['vector_store'], docstore)
+
+
+@st.cache_resource
+def user_file_router() -> Optional[FileRouter]:
+    routing = config()['vector_store'].get('routing', {})
+    if not routing.get('enabled'):
+        return None
+
+    print("Creating user file router")
+    # one small vector per file, neither bm25 nor sharding pay off for them
+    summary_store = KVectorStore(user_file_embeddings(), "user_file_summaries",
+                                 config()['vector_store'] | {'hybrid': {}, 'sharding': {}})
+    router = FileRouter(summary_store, routing.get('top_files', 20))
+    router.sync(UserFileService(db_manager()).find_user_files())
+    return router
+
+
+@st.cache_resource
+def file_summarizer() -> FileSummarizer:
+    return build_file_summarizer(config(), Kllm(config()['llms']).get_deterministic_llm(), prompts_registry())
+
+
+@st.cache_resource
+def ingestion_pipeline() -> IngestionPipeline:
+    ingestion = config().get('ingestion', {})
+    return IngestionPipeline(user_file_vector_store(), UserFileService(db_manager()), file_summarizer().summarize,
+                             user_file_router(),
+                             parse_workers=ingestion.get('parse_workers', 0),
+                             embed_workers=ingestion.get('embed_workers', 2),
+                             summary_workers=ingestion.get('summary_workers', 2),
+                             pdf_min_pages_per_task=ingestion.get('pdf_min_pages_per_task', 8),
+                             chunk_service=FileChunkService(db_manager()),
+                             stream_min_bytes=ingestion.get('stream_min_bytes', 32 * 2 ** 20),
+                             stream_block_bytes=ingestion.get('stream_block_bytes', 2 ** 20),
+                             stream_batch_size=ingestion.get('stream_batch_size', 256))
+
+
+@st.cache_resource
+def ingest_worker() -> IngestWorker:
+    print("Starting ingest worker")
+    ingestion = config().get('ingestion', {})
+    worker = IngestWorker(IngestJobService(db_manager()), ingestion_pipeline(), ingestion.get('batch_size', 8),
+                          ingestion.get('poll_seconds', 1.0), ingestion.get('worker_threads', 1))
+    worker.start()
+    return worker
 
 
 @st.cache_resource(show_spinner=False)
@@ -35,9 +96,21 @@ def db_manager():
         if not connection_string:
             raise ValueError("db.connection_string not provided!")
 
-        return DatabaseManager(database_url=connection_string)
+        return DatabaseManager(database_url=connection_string,
+                               compression_level=config()['db'].get('compression_level', 6))
 
 
 @st.cache_resource
 def prompts_registry():
     return PromptRegistry()
+
+
+def _start_ingest_worker():
+    # built on a thread of its own: a page may send no element, like the spinner of db_manager, before its
+    # set_page_config, and does not wait for the vector store to load
+    threading.Thread(target=ingest_worker, name="ingest-worker-start", daemon=True).start()
+
+
+# resumes the uploads an earlier run of the app left unfinished, started once per process as the first page imports
+# this module rather than by the pages on every load
+_start_ingest_worker()
@@ -2,7 +2,9 @@ from typing import List
 
 import streamlit as st
 
+from lib.db.model.ingest_job import IngestJob
 from lib.db.model.user_files import UserFile
+from lib.service.ingest_job_service import IngestJobService
 from lib.service.user_file_service import UserFileService
 from lib.st.cached import db_manager
 from lib.utils.session_data import SessionData
@@ -52,3 +54,28 @@ class SessionService:
     @classmethod
     def is_session_data_set(cls) -> bool:
         return "session_data" in st.session_state and st.session_state["session_data"]
+
+    @classmethod
+    def track_ingest_jobs(cls, jobs: List[IngestJob]):
+        st.session_state.setdefault("ingest_jobs", []).extend(job.id for job in jobs)
+
+    @classmethod
+    def poll_ingest_jobs(cls) -> List[IngestJob]:
+        """Tracked ingest jobs, the files of the finished ones are added to the session files and stop being tracked."""
+        job_ids = st.session_state.get("ingest_jobs")
+        if not job_ids:
+            return []
+
+        jobs = IngestJobService(db_manager()).find_by_ids(job_ids)
+        file_service = UserFileService(db_manager())
+        for job in jobs:
+            if job.status == IngestJob.DONE:
+                # a file uploaded again keeps the id it was first saved with
+                for user_file in file_service.find_by_names([job.name]):
+                    files = SessionService.get_session_files()
+                    files[:] = [file for file in files if file.name != user_file.name]
+                    SessionService.add_to_session_file(user_file)
+
+        st.session_state["ingest_jobs"] = [job.id for job in jobs
+                                           if job.status in (IngestJob.QUEUED, IngestJob.RUNNING)]
+        return jobs
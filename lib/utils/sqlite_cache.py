@@ -0,0 +1,135 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+
+class SqliteLruCache:
+    """Bytes cache kept in a single SQLite file, evicting least recently used entries beyond `max_entries`.
+
+    With `ttl_seconds` entries also expire that long after they were written.
+
+    Entries are ordered by the time they were last used and counted inside the write that evicts, so that several
+    caches on one file, in this process or another, keep to the bound. `shared` hands out one cache per file and table.
+    """
+
+    _batch_size = 500
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, path: str, max_entries: int, table: str = "cache", ttl_seconds: float = None) -> "SqliteLruCache":
+        key = (os.path.abspath(path), table)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(path, max_entries, table, ttl_seconds)
+            return cls._shared[key]
+
+    def __init__(self, path: str, max_entries: int, table: str = "cache", ttl_seconds: float = None):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.max_entries = max_entries
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                           f"(key TEXT PRIMARY KEY, value BLOB NOT NULL, last_used INTEGER NOT NULL, "
+                           f"created REAL NOT NULL DEFAULT 0)")
+        # entries of caches made before the write time was kept have none, a ttl expires them
+        columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+        if "created" not in columns:
+            self._conn.execute(f"ALTER TABLE {table} ADD COLUMN created REAL NOT NULL DEFAULT 0")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}__last_used__ind ON {table} (last_used)")
+        if ttl_seconds is not None:
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS {table}__created__ind ON {table} (created)")
+        self._conn.commit()
+
+        self._tick = 0
+        self._size = self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, bytes]:
+        keys = list(dict.fromkeys(keys))
+        found = {}
+
+        with self._lock:
+            expired_before = self._expired_before()
+            for i in range(0, len(keys), self._batch_size):
+                batch = keys[i:i + self._batch_size]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM {self.table} WHERE key IN ({placeholders}) AND created >= ?",
+                    batch + [expired_before]
+                ).fetchall()
+                found.update(rows)
+
+            if found:
+                tick = self._next_tick()
+                self._conn.executemany(f"UPDATE {self.table} SET last_used = ? WHERE key = ?",
+                                       [(tick, key) for key in found])
+                self._conn.commit()
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return found
+
+    def put(self, key: str, value: bytes):
+        self.put_many({key: value})
+
+    def put_many(self, items: Dict[str, bytes]):
+        if not items:
+            return
+
+        with self._lock:
+            tick = self._next_tick()
+            # the count and the eviction see the writes of other connections
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._expire()
+            self._conn.executemany(f"INSERT OR IGNORE INTO {self.table} (key, value, last_used, created) "
+                                   f"VALUES (?, ?, ?, ?)",
+                                   [(key, value, tick, time.time()) for key, value in items.items()])
+            self._evict()
+            self._conn.commit()
+
+    def _next_tick(self) -> int:
+        # wall clock nanoseconds order the uses of every connection, entries of older caches have small counters
+        self._tick = max(time.time_ns(), self._tick + 1)
+        return self._tick
+
+    def _expired_before(self) -> float:
+        return time.time() - self.ttl_seconds if self.ttl_seconds is not None else float("-inf")
+
+    def _expire(self):
+        # expired entries are written again, not ignored as present
+        if self.ttl_seconds is not None:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE created < ?", (self._expired_before(),))
+
+    def _evict(self):
+        self._size = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        excess = self._size - self.max_entries
+        if excess > 0:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key IN "
+                               f"(SELECT key FROM {self.table} ORDER BY last_used LIMIT ?)", (excess,))
+            self._size -= excess
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hit_rate, 3),
+                "entries": self._size, "max_entries": self.max_entries, "ttl_seconds": self.ttl_seconds}
@@ -5,7 +5,7 @@ from lib.db.model import UserFile
 from lib.service.file_chunk_service import FileChunkService
 from lib.st.session_service import SessionService
 from lib.service.user_file_service import UserFileService
-from lib.st.cached import db_manager, user_file_vector_store
+from lib.st.cached import db_manager, user_file_vector_store, user_file_router
 
 
 def remove_file(file):
@@ -22,6 +22,9 @@ def remove_file(file):
     user_file_service = UserFileService(db_manager())
     user_file_service.delete_by_id(file.id)
 
+    if user_file_router() is not None:
+        user_file_router().remove_file(file)
+
     SessionService.remove_session_file(file)
 
     st.rerun()
@@ -37,6 +40,9 @@ def edit_summary(user_file: UserFile):
                 file_service.update_summary(user_file.id, new_summary=edited_summary)
                 user_file.summary = edited_summary
 
+                if user_file_router() is not None:
+                    user_file_router().update_file(user_file)
+
                 st.rerun()
             except Exception as e:
                 print(e)
@@ -49,6 +55,9 @@ def show():
     st.write('Files are used to answer user questions. '
              'Remove old files using the `X` button. Add new files using `upload` page.')
 
+    # files uploaded in this session and processed since
+    SessionService.poll_ingest_jobs()
+
     if 'removal_message' not in st.session_state:
         st.session_state['removal_message'] = ''
 
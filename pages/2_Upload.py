@@ -1,27 +1,39 @@
-import uuid
+import hashlib
+import time
 from typing import List
 
 import streamlit as st
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 
 from Home import show_sidebar
-from lib.chain.summary_chain import summarize
-from lib.db.model import FileChunk
-from lib.db.model.user_files import UserFile
-from lib.ingest.user_file_index_builders import UserFileIndexBuilder
-from lib.service.file_chunk_service import FileChunkService
+from lib.db.model.ingest_job import IngestJob
+from lib.ingest.ingestion_pipeline import STAGES
+from lib.ingest.user_file_index_builders import is_streamable
 from lib.st.session_service import SessionService
-from lib.service.user_file_service import UserFileService
-from lib.st.cached import db_manager, user_file_vector_store
+from lib.service.ingest_job_service import IngestJobService
+from lib.st.cached import config, db_manager
 
 
 def is_duplicate(file):
+    # a saved file uploaded again with other content is updated in place
+    content_hash = hashlib.sha256(file.getvalue()).hexdigest()
     for user_file in SessionService.get_session_files():
-        if user_file.name == file.name:
+        if user_file.name == file.name and user_file.content_hash == content_hash:
+            return True
+    for job in IngestJobService(db_manager()).find_unfinished():
+        if job.name == file.name:
             return True
     return False
 
 
+def enqueue(job_service: IngestJobService, file: UploadedFile) -> IngestJob:
+    # a large file is streamed by the worker from a copy on disk instead of read whole from the database
+    if is_streamable(file.name) and file.size >= config().get('ingestion', {}).get('stream_min_bytes', 32 * 2 ** 20):
+        file.seek(0)
+        return job_service.enqueue_spooled(file.name, file)
+    return job_service.enqueue(file.name, file.getvalue())
+
+
 def show():
     uploaded_files: List[UploadedFile] = st.file_uploader(
         "Upload your files.", accept_multiple_files=True,
@@ -29,50 +41,46 @@ def show():
     )
 
     if uploaded_files:
+        # the uploader keeps its files across the reruns polling the jobs
+        queued_uploads = st.session_state.setdefault("queued_uploads", set())
         files_to_add = []
 
         for file in uploaded_files:
+            if file.file_id in queued_uploads:
+                continue
             if is_duplicate(file):
-                st.error(f"Duplicate files are not allowed: {file.name}. "
-                         "To re-upload a file try removing the file first.")
+                st.error(f"Duplicate files are not allowed: {file.name} is already uploaded or being ingested.")
                 files_to_add = []
                 break
             else:
                 files_to_add.append(file)
 
         if files_to_add:
-            builder = UserFileIndexBuilder(user_file_vector_store())
-
-            file_service = UserFileService(db_manager())
-            chunk_service = FileChunkService(db_manager())
-
-            progress_text = "Processing files. Please wait."
-            file_progress_bar = st.progress(0, text=progress_text)
-
-            for i, file in enumerate(files_to_add):
-                content = file.getvalue().decode("utf-8", errors="replace")
-                summary = summarize(content)
-
-                user_file = UserFile(
-                    id=uuid.uuid4(), name=file.name,
-                    content=content,
-                    summary=summary
-                )
-
-                doc_ids, docs = builder.create_index_user_file(file)
-                chunk_service.add_all(
-                    [FileChunk(id=uuid.uuid4(), name=file.name, idx=idx, chunk_id=doc_id,
-                               content=docs[idx].page_content if docs else None)
-                     for idx, doc_id in enumerate(doc_ids)]
-                )
-
-                user_file = file_service.save(user_file)
-
-                SessionService.add_to_session_file(user_file)
-
-                file_progress_bar.progress((i + 1) / len(files_to_add), text=progress_text)
-
-            st.switch_page("pages/1_Files.py")
+            job_service = IngestJobService(db_manager())
+            SessionService.track_ingest_jobs([enqueue(job_service, file) for file in files_to_add])
+            queued_uploads.update(file.file_id for file in files_to_add)
+
+    show_jobs()
+
+
+def show_jobs():
+    jobs = SessionService.poll_ingest_jobs()
+    if not jobs:
+        return
+
+    st.write("Files are processed in the background, you can leave this page.")
+    for job in jobs:
+        if job.status == IngestJob.FAILED:
+            st.error(f"Processing {job.name} failed: {job.error}")
+        else:
+            done = STAGES.index(job.stage) + 1 if job.stage in STAGES else 0
+            st.progress(done / len(STAGES), text=f"{job.name}: {job.stage or job.status}")
+
+    if any(job.status in (IngestJob.QUEUED, IngestJob.RUNNING) for job in jobs):
+        time.sleep(config().get('ingestion', {}).get('poll_seconds', 1.0))
+        st.rerun()
+    elif all(job.status == IngestJob.DONE for job in jobs):
+        st.switch_page("pages/1_Files.py")
 
 
 if __name__ == '__main__':
@@ -7,7 +7,7 @@ from Home import show_sidebar
 from lib.chain.chains import get_main_chain_stream
 from lib.service.chat_history_service import ChatHistoryService
 from lib.st.session_service import SessionService
-from lib.st.cached import db_manager, config, prompts_registry, user_file_vector_store
+from lib.st.cached import db_manager, config, prompts_registry, user_file_vector_store, user_file_router
 from lib.utils.chain_output_sink import ChainOutputSink
 from lib.utils.chat_history_utils import get_files_to_keep
 
@@ -30,7 +30,8 @@ def get_session_chain() -> Callable:
             print("Building chat session...")
             session_files = SessionService.get_session_files()
             st.session_state["session_chain"] = get_main_chain_stream(
-                config(), prompts_registry(), session_files, user_file_vector_store(), get_chain_sink()
+                config(), prompts_registry(), session_files, user_file_vector_store(), get_chain_sink(),
+                user_file_router()
             )
 
     return st.session_state["session_chain"]